@@ -0,0 +1,244 @@
+"""
+Benchmarks of the SalesManager hot paths.
+
+Runs headless against a fresh SQLite database (in memory by default) seeded
+with the test data of the modules it depends on and synthetic products, or
+against a copy of an existing SQLite database, and times new_ticket,
+add_product bursts, set_ticketline_amount, totals, list_tickets and
+close_ticket for the requested ticket and history sizes:
+
+    python -m cbmod.sales.benchmark --lines 10,100,1000 --history 0,10000 \\
+                                    --output results.jsonl --compare previous.jsonl
+
+Each result is one JSON line keyed by (operation, lines, history), so the
+files of different runs can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import argparse
+import platform
+import shutil
+import tempfile
+
+from sqlalchemy import create_engine
+
+import cbpos
+
+def setup_database(path=None):
+    """
+    Creates the tables in a new SQLite database and binds the session of
+    cbpos to it, which the SalesManager uses.
+    Returns the session.
+    """
+    # Register the models of all the modules the sales module depends on
+    import cbmod.currency.models
+    import cbmod.auth.models
+    import cbmod.customer.models
+    import cbmod.stock.models
+    import cbmod.sales.models
+
+    engine = create_engine('sqlite:///' + path if path else 'sqlite://')
+    cbpos.database.Base.metadata.create_all(engine)
+
+    cbpos.database.session.remove()
+    cbpos.database.session.configure(bind=engine)
+    return cbpos.database.session()
+
+def seed(session, products=2000):
+    """
+    Fills the database with the test data of the modules the sales module
+    depends on, and with synthetic products in the USD currency they define.
+    """
+    from cbmod.currency.loader import ModuleLoader as CurrencyLoader
+    from cbmod.auth.loader import ModuleLoader as AuthLoader
+    from cbmod.customer.loader import ModuleLoader as CustomerLoader
+    from cbmod.stock.loader import ModuleLoader as StockLoader
+    from cbmod.currency.models import Currency
+    from cbmod.stock.models import Product
+
+    for loader in (CurrencyLoader, AuthLoader, CustomerLoader, StockLoader):
+        loader().test_models()
+
+    usd = session.query(Currency).filter_by(id='USD').one()
+    session.add_all([Product(name='Product %d' % (i,), price=random.randint(1, 100),
+                             currency=usd, in_stock=True, quantity=10**6)
+                     for i in xrange(products)])
+    session.commit()
+
+def seed_history(session, tickets, lines_per_ticket=5):
+    """
+    Adds closed tickets to the history with bulk inserts.
+    """
+    from cbmod.sales.models import Ticket, TicketLine
+    from cbmod.stock.models import Product
+
+    product_ids = [pid for (pid,) in session.query(Product.id)]
+    start = session.query(Ticket.id).count() + 1
+    now = datetime.datetime.now()
+
+    batch = 1000
+    for first in xrange(start, start + tickets, batch):
+        ids = range(first, min(first + batch, start + tickets))
+        ticket_rows = []
+        line_rows = []
+        for ticket_id in ids:
+            subtotal = 0
+            for _ in xrange(lines_per_ticket):
+                price = random.randint(1, 100)
+                line_rows.append(dict(ticket_id=ticket_id, product_id=random.choice(product_ids),
+                                      description='', sell_price=price, amount=1, discount=0,
+                                      taxes=0, is_edited=False))
+                subtotal += price
+            ticket_rows.append(dict(id=ticket_id, date_open=now, date_close=now, date_paid=now,
+                                    payment_method='cash', discount=0, currency_id='USD',
+                                    user_id=1, subtotal=subtotal, taxes=0, total=subtotal))
+        session.execute(Ticket.__table__.insert(), ticket_rows)
+        session.execute(TicketLine.__table__.insert(), line_rows)
+    session.commit()
+
+def timed(fn, repeat):
+    """
+    Runs fn repeat times and returns the durations in seconds.
+    """
+    durations = []
+    for _ in xrange(repeat):
+        started = time.time()
+        fn()
+        durations.append(time.time() - started)
+    return durations
+
+def bench_ticket(session, lines, repeat):
+    """
+    Times the hot paths on a ticket of the given number of lines.
+    Yields (operation, durations).
+    """
+    from cbmod.sales.controllers import SalesManager
+    from cbmod.stock.models import Product
+
+    manager = SalesManager()
+    products = session.query(Product).limit(lines).all()
+
+    yield 'new_ticket', timed(lambda: manager.new_ticket(), repeat)
+
+    def burst():
+        manager.ticket = manager.new_ticket()
+        for p in products:
+            manager.add_product(p)
+    yield 'add_product_burst', timed(burst, repeat)
+
+    tl = manager.ticket.ticketlines[0]
+    amounts = iter(xrange(2, 2 + repeat))
+    yield 'set_ticketline_amount', timed(lambda: manager.set_ticketline_amount(tl, next(amounts), force=True), repeat)
+
+    yield 'totals', timed(lambda: manager.totals, repeat)
+
+    yield 'list_tickets', timed(lambda: list(manager.list_tickets()), repeat)
+    yield 'list_ticket_summaries', timed(lambda: manager.list_ticket_summaries(), repeat)
+
+    tickets = []
+    for _ in xrange(repeat):
+        manager.ticket = manager.new_ticket()
+        manager.add_products([(p, 1) for p in products])
+        tickets.append(manager.ticket)
+    remaining = iter(tickets)
+    def close():
+        manager.ticket = next(remaining)
+        manager.close_ticket('cash', True)
+    yield 'close_ticket', timed(close, repeat)
+
+def summarize(durations):
+    ordered = sorted(durations)
+    return {'min': ordered[0],
+            'median': ordered[len(ordered)//2],
+            'max': ordered[-1]}
+
+def run(line_sizes, history_sizes, repeat, existing=None, path=None):
+    """
+    Runs the benchmarks and yields one result dict per operation and sizes.
+    If existing is the path of an SQLite database, a temporary copy of it is
+    used instead of a seeded one, since the benchmarks create tickets and
+    take products out of stock.
+    """
+    copy = None
+    if existing:
+        fd, copy = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        shutil.copyfile(existing, copy)
+        session = setup_database(copy)
+    else:
+        session = setup_database(path)
+        seed(session, products=max(line_sizes))
+
+    try:
+        history = 0
+        for history_size in sorted(history_sizes):
+            if not existing and history_size > history:
+                seed_history(session, history_size - history)
+                history = history_size
+            for lines in line_sizes:
+                for operation, durations in bench_ticket(session, lines, repeat):
+                    result = {'operation': operation, 'lines': lines, 'history': history_size,
+                              'repeat': repeat}
+                    result.update(summarize(durations))
+                    yield result
+    finally:
+        if copy is not None:
+            cbpos.database.session.remove()
+            os.remove(copy)
+
+def _key(result):
+    return (result['operation'], result['lines'], result['history'])
+
+def load_results(path):
+    with open(path) as f:
+        return dict((_key(r), r) for r in (json.loads(line) for line in f if line.strip()))
+
+def _sizes(value):
+    return [int(v) for v in value.split(',') if v]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the SalesManager hot paths')
+    parser.add_argument('--lines', type=_sizes, default=[10, 100, 1000],
+                        help='comma separated ticket sizes (default: 10,100,1000)')
+    parser.add_argument('--history', type=_sizes, default=[0],
+                        help='comma separated numbers of closed tickets in the history (default: 0)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database', default=None,
+                        help='SQLite file to use instead of an in-memory database')
+    parser.add_argument('--existing', default=None, metavar='DATABASE',
+                        help='benchmark a copy of this SQLite file and its data instead of a '
+                             'synthetic database; the file itself is not changed')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('--output', default=None, help='write the results to this JSON lines file')
+    parser.add_argument('--compare', default=None, help='JSON lines results of a previous run')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    previous = load_results(args.compare) if args.compare else {}
+
+    output = open(args.output, 'w') if args.output else None
+    try:
+        sys.stdout.write('# %s, Python %s\n' % (platform.platform(), platform.python_version()))
+        sys.stdout.write('%-24s %6s %8s %12s %12s %8s\n' % ('operation', 'lines', 'history',
+                                                            'median (ms)', 'min (ms)', 'ratio'))
+        for result in run(args.lines, args.history, args.repeat, args.existing, args.database):
+            before = previous.get(_key(result))
+            ratio = '%.2f' % (result['median']/before['median'],) if before and before['median'] else '-'
+            sys.stdout.write('%-24s %6d %8d %12.3f %12.3f %8s\n' % (result['operation'],
+                                                                    result['lines'],
+                                                                    result['history'],
+                                                                    result['median']*1000,
+                                                                    result['min']*1000,
+                                                                    ratio))
+            if output is not None:
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if output is not None:
+            output.close()
+
+if __name__ == '__main__':
+    main()
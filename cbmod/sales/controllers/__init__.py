@@ -1 +1,11 @@
-from .manager import SalesManager, TicketSelectionException
\ No newline at end of file
+from .manager import SalesManager, TicketSelectionException, DebtLimitException, StockException, TicketSummary
+from .formatting import get_formatter
+from .transaction import unit_of_work
+from .worker import DatabaseWorker, AsyncSalesManager, ObjectRef, PageData
+from .scanning import ScanBatch
+from .instrumentation import capture_queries, assert_no_queries, operation, measured, OperationStats
+from .latency import LatencyRecorder, timed_handler, dump_latency
+from .importing import read_csv, read_jsonl, import_tickets
+from .concurrency import TicketConflictException, retry_on_conflict
+from .reservations import StockLedger, Shortage
+from .journal import JournalReplayException
@@ -0,0 +1,69 @@
+from functools import wraps
+
+from sqlalchemy.exc import InvalidRequestError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+
+import cbpos
+
+logger = cbpos.get_logger(__name__)
+
+class TicketConflictException(ValueError):
+    def __init__(self, ticket, error=None):
+        super(TicketConflictException, self).__init__('The ticket was changed on another terminal')
+        self.ticket = ticket
+        self.error = error
+
+def _refresh(manager):
+    """
+    Reloads the current ticket after a conflict. Returns False if it was
+    deleted or closed in the meantime, in which case there is nothing to retry.
+    """
+    t = manager.ticket
+    if t is None:
+        return True
+    try:
+        cbpos.database.session().refresh(t)
+    except InvalidRequestError:
+        return False
+    return not t.closed
+
+def retry_on_conflict(fn, retries=2):
+    """
+    Decorator running a SalesManager operation again on the refreshed ticket
+    when its flush finds a ticket or ticketline version changed by another
+    terminal, or when another terminal created the same rollup or balance
+    row in the meantime. TicketConflictException is raised if it still conflicts after
+    the retries, or if the ticket was deleted or closed meanwhile.
+
+    With a journal open, the grouped operations rolled back along with the
+    conflict are replayed, and the conflict is raised without retrying.
+    """
+    @wraps(fn)
+    def _retry_on_conflict(manager, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return fn(manager, *args, **kwargs)
+            except (StaleDataError, IntegrityError) as e:
+                error = e
+            except InvalidRequestError as e:
+                # An object of the arguments was deleted by the other terminal
+                if attempt == 0:
+                    raise
+                error = e
+
+            session = cbpos.database.session()
+            session.rollback()
+            manager.stock.invalidate()
+            t = manager.ticket
+            logger.info('Conflict in %s (attempt %d): %s', fn.__name__, attempt+1, error)
+
+            if manager.journal is not None:
+                if not manager.journal.replaying:
+                    manager.replay_journal()
+                raise TicketConflictException(t, error)
+
+            attempt += 1
+            if attempt > retries or not _refresh(manager):
+                raise TicketConflictException(t, error)
+    return _retry_on_conflict
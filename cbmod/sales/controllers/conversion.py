@@ -0,0 +1,57 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from pydispatch import dispatcher
+
+import cbpos
+
+import cbmod.currency.controllers as currency
+
+logger = cbpos.get_logger(__name__)
+
+class ConversionCache(object):
+    """
+    Caches the conversion rates between pairs of currencies, keyed by
+    (source, destination) currency id.
+    The rates are dropped when the 'currency-rates-changed' signal is sent.
+    Converted values are rounded to the decimal places of the destination
+    currency, as currency.convert does.
+    """
+    
+    # The rate is taken from the conversion of a large round value, so that
+    # it stays precise even if currency.convert rounds its result
+    RATE_BASE = Decimal(10)**9
+    
+    def __init__(self):
+        self.rates = {}
+        dispatcher.connect(self.invalidate, signal='currency-rates-changed')
+    
+    def invalidate(self, **kwargs):
+        self.rates.clear()
+    
+    def rate(self, src, dst):
+        key = (src.id, dst.id)
+        try:
+            return self.rates[key]
+        except KeyError:
+            rate = Decimal(currency.convert(self.RATE_BASE, src, dst))/self.RATE_BASE
+            self.rates[key] = rate
+            return rate
+    
+    def convert(self, value, src, dst):
+        if src == dst:
+            return value
+        return _round(_decimal(value)*self.rate(src, dst), dst)
+    
+    def convert_many(self, values, src, dst):
+        if src == dst:
+            return list(values)
+        rate = self.rate(src, dst)
+        return [_round(_decimal(value)*rate, dst) for value in values]
+
+def _decimal(value):
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return value
+
+def _round(value, c):
+    return value.quantize(Decimal(10)**-c.decimal_places, rounding=ROUND_HALF_UP)
@@ -0,0 +1,45 @@
+import babel
+import babel.numbers
+
+import cbpos
+
+class NumberFormatter(object):
+    """
+    Formats numbers, percents and currency amounts for one locale.
+    The locale and its patterns are parsed once, instead of on every call
+    like the babel.numbers.format_* functions do.
+    """
+    
+    def __init__(self, locale):
+        self.locale = babel.Locale.parse(locale)
+        self.number_pattern = self.locale.decimal_formats.get(None)
+        self.percent_pattern = self.locale.percent_formats.get(None)
+        self.currency_patterns = {}
+    
+    def number(self, value):
+        return self.number_pattern.apply(value, self.locale)
+    
+    def percent(self, value):
+        return self.percent_pattern.apply(value, self.locale)
+    
+    def currency(self, value, code):
+        try:
+            pattern = self.currency_patterns[code]
+        except KeyError:
+            pattern = self.currency_patterns[code] = self.locale.currency_formats.get(None)
+        return pattern.apply(value, self.locale, currency=code)
+
+_formatters = {}
+
+def get_formatter(locale=None):
+    """
+    Returns the shared formatter of the locale, by default the current one.
+    """
+    if locale is None:
+        locale = cbpos.locale
+    key = str(locale)
+    try:
+        return _formatters[key]
+    except KeyError:
+        formatter = _formatters[key] = NumberFormatter(locale)
+        return formatter
@@ -0,0 +1,217 @@
+import csv
+import json
+import decimal
+import datetime
+from itertools import groupby
+
+from sqlalchemy import bindparam, func, select
+
+import cbpos
+
+import cbmod.currency.controllers as currency
+
+from cbmod.sales.models import Ticket, TicketLine, TicketTotals, CustomerBalance, DailyRollup
+from cbmod.sales.controllers.transaction import unit_of_work
+
+from cbmod.stock.models.product import Product
+from cbmod.currency.models import Currency
+from cbmod.customer.models import Customer
+
+logger = cbpos.get_logger(__name__)
+
+TICKET_FIELDS = ('date_open', 'date_close', 'date_paid', 'payment_method', 'comment',
+                 'discount', 'currency_id', 'customer_id', 'user_id')
+
+def _datetime(value):
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date: %r' % (value,))
+
+def _int(value, default=None):
+    return int(value) if value not in (None, '') else default
+
+def _money(value):
+    return decimal.Decimal(value) if value not in (None, '') else decimal.Decimal(0)
+
+def _bool(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+def _unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def _ticket(data, lines):
+    return {'date_open': _datetime(data.get('date_open')),
+            'date_close': _datetime(data.get('date_close')),
+            'date_paid': _datetime(data.get('date_paid')),
+            'payment_method': _unicode(data.get('payment_method')) or None,
+            'comment': _unicode(data.get('comment')) or None,
+            'discount': _int(data.get('discount')) or 0,
+            'currency_id': _unicode(data.get('currency_id')) or None,
+            'customer_id': _int(data.get('customer_id')),
+            'user_id': _int(data.get('user_id')),
+            'lines': lines}
+
+def _line(data, prefix=''):
+    return {'product_id': _int(data.get('product_id')),
+            'description': _unicode(data.get('description')) or u'',
+            'sell_price': _money(data.get('sell_price')),
+            'amount': _int(data.get('amount'), 1),
+            'discount': _int(data.get(prefix+'discount')) or 0,
+            'taxes': _money(data.get('taxes')),
+            'is_edited': _bool(data.get('is_edited'))}
+
+def read_csv(fileobj):
+    """
+    Reads tickets from a CSV file with one row per ticketline. Consecutive
+    rows with the same "ticket" column belong to the same ticket, whose
+    fields are read from its first row. The discount of the line is in
+    the "line_discount" column.
+    Yields the tickets as dicts with their "lines", one at a time.
+    """
+    for _, rows in groupby(csv.DictReader(fileobj), key=lambda row: row['ticket']):
+        rows = list(rows)
+        yield _ticket(rows[0], [_line(row, prefix='line_') for row in rows])
+
+def read_jsonl(fileobj):
+    """
+    Reads tickets from a JSON lines file, one ticket per line with its
+    ticketlines in a "lines" list.
+    Yields the tickets as dicts with their "lines", one at a time.
+    """
+    for line in fileobj:
+        if line.strip():
+            data = json.loads(line, parse_float=decimal.Decimal)
+            yield _ticket(data, [_line(l) for l in data.get('lines', ())])
+
+def _reserve_ids(session, table, count):
+    """
+    Returns count ids for new rows of the table. On PostgreSQL they are taken
+    from the sequence of the table, so that the tickets inserted meanwhile by
+    other terminals get other ids. Elsewhere they follow the largest id.
+    """
+    if session.bind.dialect.name == 'postgresql':
+        rows = session.execute("SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                               "FROM generate_series(1, :count)",
+                               {'table': table.name, 'count': count})
+        return [row[0] for row in rows]
+    first = (session.execute(select([func.max(table.c.id)])).scalar() or 0) + 1
+    return range(first, first + count)
+
+def _add_up(sums, key, values):
+    if key in sums:
+        sums[key] = [a+b for a, b in zip(sums[key], values)]
+    else:
+        sums[key] = list(values)
+
+def _update_balances(session, debts):
+    """
+    Adds the {(customer id, currency id): total} of the unpaid debt tickets
+    to the balances of their customers.
+    """
+    currencies = dict((c.id, c) for c in session.query(Currency) \
+                        .filter(Currency.id.in_(set(c for _, c in debts))))
+    customers = dict((c.id, c) for c in session.query(Customer) \
+                        .filter(Customer.id.in_(set(c for c, _ in debts))))
+    for (customer_id, currency_id), (total,) in debts.iteritems():
+        c = customers[customer_id]
+        CustomerBalance.add(c, currency.convert(total, currencies[currency_id], c.currency))
+
+def import_tickets(tickets, chunk_size=500, move_stock=False, update_summaries=False):
+    """
+    Inserts the tickets (dicts as yielded by read_csv or read_jsonl) and their
+    ticketlines with core statements, in a single transaction. The tickets and
+    their ticketlines are inserted with one executemany each per chunk of
+    tickets, with ids reserved for the whole chunk beforehand (see
+    _reserve_ids). The running totals of the tickets are computed while reading them.
+
+    If move_stock is set, the amounts of the closed tickets are summed by
+    product and taken out of stock with one executemany at the end.
+
+    If update_summaries is set, the imported tickets are added to the daily
+    rollup and to the customer balances, summed by row the same way.
+    Returns the number of imported tickets.
+    """
+    tickets_table = Ticket.__table__
+    ticket_insert = tickets_table.insert()
+    line_insert = TicketLine.__table__.insert()
+
+    count = 0
+    moved = {}
+    rollup = {}
+    debts = {}
+    rows = []
+    lines = []
+    ids = None
+    with unit_of_work() as session:
+        def insert_chunk():
+            session.execute(ticket_insert, rows)
+            if lines:
+                session.execute(line_insert, lines)
+            del rows[:], lines[:]
+
+        for data in tickets:
+            if ids is None:
+                ids = iter(_reserve_ids(session, tickets_table, chunk_size))
+            ticket_id = next(ids)
+
+            totals = TicketTotals.zero
+            for line in data['lines']:
+                subtotal = line['amount']*line['sell_price']
+                line_totals = TicketTotals(subtotal, line['taxes'],
+                                           (line['taxes'] + subtotal) * (100-line['discount'])/100)
+                totals += line_totals
+
+                lines.append(dict(line, ticket_id=ticket_id))
+                if data['date_close'] is not None:
+                    if move_stock and line['product_id'] is not None:
+                        moved[line['product_id']] = moved.get(line['product_id'], 0) + line['amount']
+                    if update_summaries:
+                        key = (data['date_close'].date(), data['user_id'], data['payment_method'],
+                               data['currency_id'], line['product_id'])
+                        _add_up(rollup, key, (line['amount'],) + line_totals.discounted(data['discount']))
+
+            row = dict((field, data[field]) for field in TICKET_FIELDS)
+            row.update(id=ticket_id, subtotal=totals.subtotal, taxes=totals.taxes, total=totals.total)
+            rows.append(row)
+
+            if update_summaries and data['payment_method'] == 'debt' and \
+                    data['date_paid'] is None and data['customer_id'] is not None:
+                _add_up(debts, (data['customer_id'], data['currency_id']),
+                        (totals.discounted(data['discount']).total,))
+
+            count += 1
+            if count % chunk_size == 0:
+                insert_chunk()
+                # Reserved again, in case another terminal inserted tickets meanwhile
+                ids = None
+
+        if rows:
+            insert_chunk()
+
+        fields = ('amount', 'subtotal', 'taxes', 'total')
+        for (day, user_id, payment_method, currency_id, product_id), values in rollup.iteritems():
+            DailyRollup.add(dict(day=day, user_id=user_id, payment_method=payment_method,
+                                 currency_id=currency_id, product_id=product_id),
+                            dict(zip(fields, values)))
+        if debts:
+            _update_balances(session, debts)
+
+        if moved:
+            products = Product.__table__
+            session.execute(products.update() \
+                                .where((products.c.id == bindparam('product')) & products.c.in_stock) \
+                                .values(quantity=products.c.quantity - bindparam('moved')),
+                            [{'product': product_id, 'moved': amount}
+                             for product_id, amount in moved.iteritems()])
+
+    logger.info('Imported %d tickets', count)
+    return count
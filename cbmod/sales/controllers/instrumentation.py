@@ -0,0 +1,163 @@
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+from pydispatch import dispatcher
+
+from sqlalchemy import event
+
+import cbpos
+
+logger = cbpos.get_logger(__name__)
+
+_local = threading.local()
+_instrumented = set()
+_budgets = None
+
+def _captures():
+    try:
+        return _local.captures
+    except AttributeError:
+        _local.captures = []
+        return _local.captures
+
+def _operations():
+    try:
+        return _local.operations
+    except AttributeError:
+        _local.operations = []
+        return _local.operations
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    for statements in _captures():
+        statements.append(statement)
+    # Kept on the execution context, which is dropped along with it if the
+    # statement fails
+    if context is not None:
+        context._sales_query_start = time.time()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_sales_query_start', None)
+    duration = time.time()-start if start is not None else 0
+    for stats in _operations():
+        stats.statements.append((statement, duration))
+
+def instrument(bind=None):
+    """
+    Installs the statement listeners on the engine, once.
+    """
+    if bind is None:
+        bind = cbpos.database.session().get_bind(None)
+    if bind not in _instrumented:
+        event.listen(bind, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(bind, 'after_cursor_execute', _after_cursor_execute)
+        _instrumented.add(bind)
+    return bind
+
+@contextmanager
+def capture_queries(bind=None):
+    """
+    Collects the SQL statements the current thread executes during the block.
+    """
+    instrument(bind)
+    statements = []
+    captures = _captures()
+    captures.append(statements)
+    try:
+        yield statements
+    finally:
+        captures.remove(statements)
+
+@contextmanager
+def assert_no_queries(bind=None):
+    """
+    Raises an AssertionError if the block executes any SQL statement,
+    e.g. a lazy load while rendering an eagerly loaded ticket.
+    """
+    with capture_queries(bind) as statements:
+        yield
+    if statements:
+        raise AssertionError('%d unexpected queries:\n%s' % (len(statements),
+                                                             '\n'.join(statements)))
+
+class OperationStats(object):
+    """
+    The SQL statements a sales operation executed, with their durations.
+    """
+    
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.statements = []
+        self.duration = 0
+    
+    @property
+    def count(self):
+        return len(self.statements)
+    
+    @property
+    def sql_duration(self):
+        return sum(duration for _, duration in self.statements)
+    
+    def __repr__(self):
+        return '<OperationStats %s: %d queries, %.1fms in SQL, %.1fms total>' % \
+                (self.name, self.count, self.sql_duration*1000, self.duration*1000)
+
+def query_budgets():
+    """
+    Returns the per-operation query budgets set in the configuration,
+    e.g. "add_product=4, close_ticket=10". They are read once.
+    """
+    global _budgets
+    if _budgets is None:
+        budgets = {}
+        for item in (cbpos.config['mod.sales', 'query_budgets'] or '').split(','):
+            if '=' in item:
+                name, budget = item.split('=', 1)
+                budgets[name.strip()] = int(budget)
+        _budgets = budgets
+    return _budgets
+
+@contextmanager
+def operation(name, bind=None):
+    """
+    Attributes the SQL statements of the block to the named operation.
+    Statements of nested operations count for the outer ones as well.
+    
+    On exit the stats are logged and sent with the sales-query-stats signal,
+    with a warning if the operation went over its query budget.
+    """
+    instrument(bind)
+    operations = _operations()
+    stats = OperationStats(name, operations[-1].name if operations else None)
+    operations.append(stats)
+    started = time.time()
+    try:
+        yield stats
+    finally:
+        stats.duration = time.time()-started
+        operations.remove(stats)
+        _report(stats)
+
+def _report(stats):
+    logger.debug('%r', stats)
+    budget = query_budgets().get(stats.name)
+    if budget is not None and stats.count > budget:
+        logger.warning('%s executed %d queries, over its budget of %d:\n%s',
+                       stats.name, stats.count, budget,
+                       '\n'.join(statement for statement, _ in stats.statements))
+    dispatcher.send(signal='sales-query-stats', sender='sales', stats=stats)
+
+def measured(fn):
+    """
+    Decorator measuring every call of fn as an operation named after it,
+    when query_stats is set in the configuration.
+    """
+    @wraps(fn)
+    def _measured(*args, **kwargs):
+        if not cbpos.config['mod.sales', 'query_stats']:
+            return fn(*args, **kwargs)
+        with operation(fn.__name__):
+            return fn(*args, **kwargs)
+    return _measured
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import decimal
+from functools import wraps
+
+import cbpos
+
+from cbmod.sales.models import Ticket, TicketLine
+
+from cbmod.stock.models.product import Product
+from cbmod.currency.models import Currency
+from cbmod.customer.models import Customer
+
+logger = cbpos.get_logger(__name__)
+
+class JournalReplayException(RuntimeError):
+    def __init__(self, entry, error):
+        super(JournalReplayException, self).__init__('Could not replay the journal entry %r: %s' % (entry, error))
+        self.entry = entry
+        self.error = error
+
+def _lines(t):
+    """
+    Returns the ticketlines of the ticket by id.
+    """
+    if t is None:
+        return {}
+    return dict((tl.id, tl) for tl in t.ticketlines)
+
+class Journal(object):
+    """
+    Append-only file of the SalesManager operations, one JSON line each.
+    Appends are fsynced in batches: after sync_every entries, or at the first
+    append or sync() call sync_interval seconds after the last fsync.
+
+    Objects are written as references by id. The tickets and ticketlines
+    created since the last commit are referenced by the sequence number of
+    the operation that created them instead, since the replay creates them
+    again under other ids.
+    """
+
+    def __init__(self, path, sync_interval=0.2, sync_every=50):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_every = sync_every
+
+        self.seq = 0
+        self.unsynced = 0
+        self.synced_at = time.time()
+        self.replaying = False
+
+        # Ids of the tickets and ticketlines created since the last commit,
+        # and their references
+        self.created = {}
+        self.created_lines = {}
+        # Tickets and ticketlines created again by the replay, by reference
+        self.replayed = {}
+        self.replayed_lines = {}
+
+        self.fileobj = open(path, 'ab')
+
+    def entries(self):
+        """
+        Returns the entries of the journal, without the last one if it was torn
+        by a crash.
+        """
+        self.fileobj.flush()
+        entries = []
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.warning('Ignoring a torn journal entry in %s', self.path)
+                    break
+        return entries
+
+    def append(self, seq, op, ticket, args, kwargs, lines):
+        self.fileobj.write(json.dumps({'seq': seq, 'op': op, 'ticket': ticket,
+                                       'args': args, 'kwargs': kwargs, 'lines': lines},
+                                      separators=(',', ':')) + '\n')
+        self.seq = seq
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+        else:
+            self.sync_due()
+
+    def sync_due(self):
+        """
+        Fsyncs the pending appends if the sync interval elapsed.
+        """
+        if self.unsynced and time.time()-self.synced_at >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def truncate(self):
+        """
+        Empties the journal once its operations are committed to the database.
+        """
+        self.fileobj.truncate(0)
+        self.sync()
+        self.created.clear()
+        self.created_lines.clear()
+
+    def close(self):
+        self.sync()
+        self.fileobj.close()
+
+    # References
+
+    def ticket_ref(self, t):
+        if t is None:
+            return None
+        return self.created.get(t.id, t.id)
+
+    def lines_created(self, seq, lines):
+        """
+        Registers the ticketlines created by the operation seq, in id order.
+        """
+        for i, line_id in enumerate(sorted(lines)):
+            self.created_lines[line_id] = 'new:%d:%d' % (seq, i)
+
+    def lines_replayed(self, seq, lines):
+        for i, line_id in enumerate(sorted(lines)):
+            self.replayed_lines['new:%d:%d' % (seq, i)] = lines[line_id]
+
+    def encode(self, value):
+        if isinstance(value, Ticket):
+            return {'ticket': self.ticket_ref(value)}
+        elif isinstance(value, TicketLine):
+            return {'line': self.created_lines.get(value.id, value.id)}
+        elif isinstance(value, Product):
+            return {'product': value.id}
+        elif isinstance(value, Customer):
+            return {'customer': value.id}
+        elif isinstance(value, Currency):
+            return {'currency': value.id}
+        elif isinstance(value, decimal.Decimal):
+            return {'decimal': str(value)}
+        elif isinstance(value, dict):
+            return {'dict': dict((k, self.encode(v)) for k, v in value.iteritems())}
+        elif isinstance(value, (list, tuple)):
+            return [self.encode(v) for v in value]
+        else:
+            return value
+
+    def ticket(self, ref):
+        if ref is None:
+            return None
+        elif isinstance(ref, basestring):
+            return self.replayed[ref]
+        else:
+            return cbpos.database.session().query(Ticket).get(ref)
+
+    def decode(self, value):
+        session = cbpos.database.session()
+        if isinstance(value, list):
+            return [self.decode(v) for v in value]
+        elif not isinstance(value, dict):
+            return value
+
+        (kind, ref), = value.items()
+        if kind == 'ticket':
+            return self.ticket(ref)
+        elif kind == 'line':
+            if isinstance(ref, basestring):
+                return self.replayed_lines[ref]
+            tl = session.query(TicketLine).get(ref)
+            if tl is None:
+                raise ValueError('Ticketline %s not found' % (ref,))
+            return tl
+        elif kind == 'product':
+            return session.query(Product).get(ref)
+        elif kind == 'customer':
+            return session.query(Customer).get(ref)
+        elif kind == 'currency':
+            return session.query(Currency).get(ref)
+        elif kind == 'decimal':
+            return decimal.Decimal(ref)
+        elif kind == 'dict':
+            return dict((k, self.decode(v)) for k, v in ref.iteritems())
+        raise ValueError('Unknown journal reference: %r' % (value,))
+
+def journaled(fn):
+    """
+    Decorator appending the successful calls of a SalesManager operation to
+    the journal of the manager, if it has one. The sequence number is stored
+    in the same transaction as the changes of the operation.
+    A sequence number is never used again, even if the operation fails, since
+    it may have been committed already.
+    """
+    @wraps(fn)
+    def _journaled(manager, *args, **kwargs):
+        journal = manager.journal
+        if journal is None or journal.replaying:
+            return fn(manager, *args, **kwargs)
+
+        seq = journal.seq+1
+        t = manager.ticket
+        ticket = journal.ticket_ref(t)
+        encoded_args = journal.encode(args)
+        encoded_kwargs = dict((k, journal.encode(v)) for k, v in kwargs.iteritems())
+        before = _lines(t)
+
+        manager.journal_state.seq = seq
+        try:
+            result = fn(manager, *args, **kwargs)
+        except:
+            # E.g. close_ticket commits the grouped operations before failing
+            journal.seq = seq
+            raise
+
+        created = set(_lines(manager.ticket if manager.ticket is t else None)) - set(before)
+        journal.append(seq, fn.__name__, ticket, encoded_args, encoded_kwargs, len(created))
+        journal.lines_created(seq, created)
+        if isinstance(result, Ticket):
+            journal.created[result.id] = 'new:%d' % (seq,)
+
+        manager.journal_operation_done()
+        return result
+    return _journaled
+
+def replay(manager):
+    """
+    Applies again the entries of the journal of the manager that did not reach
+    the database, committing each of them.
+    Stops at the first entry that cannot be applied, raising JournalReplayException,
+    so that the journal is kept for the entries that were not replayed.
+    Returns the number of replayed operations.
+    """
+    journal = manager.journal
+    state = manager.journal_state
+    session = cbpos.database.session()
+
+    count = 0
+    journal.replaying = True
+    try:
+        for entry in journal.entries():
+            seq = entry['seq']
+            if seq <= state.seq:
+                continue
+
+            try:
+                t = manager.ticket = journal.ticket(entry['ticket'])
+                args = journal.decode(entry['args'])
+                kwargs = dict((str(k), journal.decode(v)) for k, v in entry.get('kwargs', {}).iteritems())
+                before = _lines(t)
+                state.seq = seq
+
+                op = entry['op']
+                if isinstance(getattr(type(manager), op), property):
+                    setattr(manager, op, *args)
+                    result = None
+                else:
+                    result = getattr(manager, op)(*args, **kwargs)
+
+                created = _lines(manager.ticket if manager.ticket is t else None)
+                for line_id in before:
+                    created.pop(line_id, None)
+                if len(created) != entry.get('lines', len(created)):
+                    raise ValueError('%d ticketlines created instead of %d' % (len(created), entry['lines']))
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                logger.exception('Could not replay the journal entry %r', entry)
+                raise JournalReplayException(entry, e)
+
+            journal.lines_replayed(seq, created)
+            if isinstance(result, Ticket):
+                journal.replayed['new:%d' % (seq,)] = result
+            journal.seq = seq
+            count += 1
+    finally:
+        journal.replaying = False
+        journal.replayed.clear()
+        journal.replayed_lines.clear()
+        manager.ticket = None
+
+    journal.seq = max(journal.seq, state.seq)
+    return count
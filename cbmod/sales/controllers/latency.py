@@ -0,0 +1,91 @@
+import sys
+import time
+from functools import wraps
+from collections import deque
+from contextlib import contextmanager
+
+import cbpos
+
+logger = cbpos.get_logger(__name__)
+
+class LatencyRecorder(object):
+    """
+    Keeps the most recent wall times of named actions (event handlers,
+    page refresh phases) and reports their percentiles.
+    """
+
+    def __init__(self, size=2000):
+        self.size = size
+        self.samples = {}
+
+    def record(self, name, seconds):
+        try:
+            samples = self.samples[name]
+        except KeyError:
+            samples = self.samples[name] = deque(maxlen=self.size)
+        samples.append(seconds)
+
+        threshold = cbpos.config['mod.sales', 'slow_action_ms']
+        if threshold and seconds*1000 > float(threshold):
+            logger.warning('Slow action %s: %.1fms', name, seconds*1000)
+
+    @contextmanager
+    def timed(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time()-started)
+
+    def percentiles(self, name, points=(50, 95, 99)):
+        """
+        Returns the given percentiles, in seconds, of the recorded times of name.
+        """
+        ordered = sorted(self.samples.get(name, ()))
+        if not ordered:
+            return [None for _ in points]
+        return [ordered[min(len(ordered)-1, len(ordered)*p//100)] for p in points]
+
+    def dump(self, stream=None):
+        """
+        Writes the p50/p95/p99 and maximum of every action, in milliseconds.
+        """
+        if stream is None:
+            stream = sys.stdout
+        stream.write('%-40s %8s %10s %10s %10s %10s\n' % ('action', 'count', 'p50', 'p95', 'p99', 'max'))
+        for name in sorted(self.samples):
+            p50, p95, p99 = self.percentiles(name)
+            stream.write('%-40s %8d %10.1f %10.1f %10.1f %10.1f\n' % (name, len(self.samples[name]),
+                                                                      p50*1000, p95*1000, p99*1000,
+                                                                      max(self.samples[name])*1000))
+
+    def clear(self):
+        self.samples.clear()
+
+recorder = LatencyRecorder()
+
+def timed_handler(fn):
+    """
+    Decorator recording the wall time of every call of a page method
+    as "<class name>.<method name>".
+    """
+    @wraps(fn)
+    def _timed_handler(self, *args, **kwargs):
+        with recorder.timed('%s.%s' % (type(self).__name__, fn.__name__)):
+            return fn(self, *args, **kwargs)
+    return _timed_handler
+
+def dump_latency(path=None):
+    """
+    Writes the latency percentiles to path, or to the configured latency_dump file,
+    or to the log if neither is set.
+    """
+    path = path or cbpos.config['mod.sales', 'latency_dump']
+    if path:
+        with open(path, 'w') as f:
+            recorder.dump(f)
+    else:
+        from StringIO import StringIO
+        stream = StringIO()
+        recorder.dump(stream)
+        logger.info('Sales latency:\n%s', stream.getvalue())
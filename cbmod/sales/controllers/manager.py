@@ -1,13 +1,29 @@
+import time
+import socket
+from collections import namedtuple
+
 from pydispatch import dispatcher
 
+from sqlalchemy import func, select, event
+from sqlalchemy.orm import joinedload, subqueryload_all
+from sqlalchemy.orm.attributes import instance_state
+
 import cbpos
 
 from cbmod.auth.controllers import user
 import cbmod.currency.controllers as currency
 
-from cbmod.sales.models import Ticket, TicketLine
+from cbmod.sales.models import Ticket, TicketLine, TicketTotals, CustomerBalance, DailyRollup, JournalState
+from cbmod.sales.controllers.conversion import ConversionCache
+from cbmod.sales.controllers.transaction import unit_of_work
+from cbmod.sales.controllers.instrumentation import measured
+from cbmod.sales.controllers.importing import import_tickets
+from cbmod.sales.controllers.journal import Journal, JournalReplayException, journaled, replay
+from cbmod.sales.controllers.concurrency import retry_on_conflict
+from cbmod.sales.controllers.reservations import StockLedger, product_id, line_amounts, shortages
 
 from cbmod.currency.models import Currency
+from cbmod.customer.models import Customer
 
 logger = cbpos.get_logger(__name__)
 
@@ -15,10 +31,79 @@ class TicketSelectionException(ValueError):
     def __init__(self):
         super(TicketSelectionException, self).__init__('No ticket selected')
 
+class DebtLimitException(ValueError):
+    def __init__(self, customer):
+        super(DebtLimitException, self).__init__('Maximum debt of the customer exceeded')
+        self.customer = customer
+
+class StockException(ValueError):
+    def __init__(self, shortages):
+        super(StockException, self).__init__('Amount in stock is smaller than the ticket amount')
+        self.shortages = shortages
+
+TicketSummary = namedtuple('TicketSummary', 'id display customer line_count total')
+
 class SalesManager(object):
     
+    # Parts of the sales page an operation can invalidate
+    TICKETS = 'tickets'
+    CURRENCIES = 'currencies'
+    CUSTOMER = 'customer'
+    DISCOUNT = 'discount'
+    LINES = 'lines'
+    TOTALS = 'totals'
+    CATALOG = 'catalog'
+    
+    REGIONS = frozenset((TICKETS, CURRENCIES, CUSTOMER, DISCOUNT, LINES, TOTALS, CATALOG))
+    
     def __init__(self):
-        pass
+        self.dirty = set(self.REGIONS)
+        self.conversions = ConversionCache()
+        self.stock = StockLedger()
+        dispatcher.connect(self.forget_default_currency, signal='currency-rates-changed')
+    
+    def invalidate(self, *regions):
+        """
+        Marks the given parts of the page as needing a refresh.
+        """
+        self.dirty.update(regions)
+    
+    def take_dirty(self):
+        """
+        Returns the parts of the page invalidated since the last call, and clears them.
+        """
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+    
+    def _save(self, item, **data):
+        """
+        Stores the item like Item.update, but only flushes it while the
+        journal groups the commits.
+        """
+        if self.journal is None:
+            item.update(**data)
+        else:
+            for field, value in data.iteritems():
+                setattr(item, field, value)
+            session = cbpos.database.session()
+            session.add(item)
+            session.flush()
+    
+    def _remove(self, item):
+        """
+        Deletes the item like Item.delete, but only flushes it while the
+        journal groups the commits.
+        """
+        if self.journal is None:
+            item.delete()
+        else:
+            # Without the commit the collection of the ticket is not expired,
+            # so the line is taken out of it explicitly
+            if isinstance(item, TicketLine) and item.ticket is not None:
+                item.ticket.ticketlines.remove(item)
+            session = cbpos.database.session()
+            session.delete(item)
+            session.flush()
     
     # Ticket Management
     
@@ -27,111 +112,273 @@ class SalesManager(object):
     def ticket(self):
         return self.__ticket
     
+    def show_ticket(self, t):
+        """
+        Makes t the current ticket only to render it, e.g. a ticket loaded on
+        the database worker, without the side effects of setting the ticket.
+        """
+        self.__ticket = t
+    
     @ticket.setter
     def ticket(self, t):
         self.__ticket = t
+        # Rates are not expected to change in the middle of a sale
+        self.conversions.invalidate()
+        self.invalidate(self.TICKETS, self.CURRENCIES, self.CUSTOMER,
+                        self.DISCOUNT, self.LINES, self.TOTALS)
         self.update_taxes()
     
+    @measured
+    @journaled
     def new_ticket(self):
-        c = currency.default
+        c = self.default_currency
         t = Ticket()
-        t.update(discount=0, user=user.current, currency=c)
+        self._save(t, discount=0, user=user.current, currency=c)
+        self.invalidate(self.TICKETS)
         self.update_taxes()
         return t
     
+    @measured
+    @retry_on_conflict
+    @journaled
     def cancel_ticket(self):
         if self.ticket is None:
             raise TicketSelectionException()
-        self.ticket.delete()
+        for pid, amount in line_amounts(self.ticket).iteritems():
+            self.stock.reserve(pid, -amount)
+        self._remove(self.ticket)
+        self.invalidate(self.TICKETS)
         self.ticket = None
     
-    def close_ticket(self, payment_method, paid):
+    @measured
+    @retry_on_conflict
+    @journaled
+    def close_ticket(self, payment_method, paid, force=False):
+        """
+        Pays and closes the current ticket and takes its products out of stock,
+        all in one transaction. Nothing is kept if any step fails.
+        Raises StockException if the stock of its products is short, unless forced.
+        """
         if self.ticket is None:
             raise TicketSelectionException()
-        self.ticket.pay(unicode(payment_method), bool(paid))
-        self.ticket.closed = True
+        
+        t = self.ticket
+        is_debt = payment_method == 'debt' and not paid and t.customer is not None
+        if is_debt and not self.is_debt_allowed(t.customer, t.total):
+            raise DebtLimitException(t.customer)
+        
+        if not force:
+            short = self.stock_shortages()
+            if short:
+                raise StockException(short)
+        
+        # A failing close must not roll back the grouped operations with it
+        self.commit_journal()
+        
+        amounts = line_amounts(t)
+        with unit_of_work():
+            if is_debt:
+                CustomerBalance.add(t.customer, currency.convert(t.total, t.currency, t.customer.currency))
+            t.close(unicode(payment_method), bool(paid))
+            DailyRollup.add_ticket(t)
+        self.stock.consume(amounts)
+        self.invalidate(self.TICKETS, self.CATALOG)
     
     def list_tickets(self):
         session = cbpos.database.session()
         return session.query(Ticket).filter(~Ticket.closed)
     
+    @measured
+    def list_ticket_summaries(self):
+        """
+        Returns a TicketSummary of every open ticket, from a single query
+        and without loading the tickets themselves.
+        """
+        session = cbpos.database.session()
+        line_count = select([func.count(TicketLine.id)]) \
+                        .where(TicketLine.ticket_id == Ticket.id).as_scalar()
+        query = session.query(Ticket.id, Ticket.display, Customer.name, line_count, Ticket.total) \
+                        .outerjoin(Ticket.customer) \
+                        .filter(~Ticket.closed) \
+                        .order_by(Ticket.id)
+        return [TicketSummary(*row) for row in query]
+    
+    # Everything rendering or printing a ticket touches: the ticket with its
+    # currency and customer, then its lines, then their products (3 queries)
+    ticket_load_plan = (joinedload(Ticket.currency),
+                        joinedload(Ticket.customer),
+                        subqueryload_all(Ticket.ticketlines, TicketLine._product))
+    
+    @measured
+    def get_ticket(self, ticket_id):
+        """
+        Loads the ticket following the ticket_load_plan.
+        """
+        session = cbpos.database.session()
+        return session.query(Ticket).options(*self.ticket_load_plan) \
+                        .filter(Ticket.id == ticket_id).first()
+    
+    @measured
+    def load_ticket(self):
+        """
+        Loads the current ticket again following the ticket_load_plan, e.g.
+        after a commit expired it, so that rendering it needs no lazy loads.
+        """
+        t = self.get_ticket(self.ticket.id) if self.ticket is not None else None
+        c = self.currency
+        if (t is None or c is not t.currency) and instance_state(c).expired:
+            # The display currency is used as well
+            cbpos.database.session().refresh(c)
+    
     @property
-    def subtotal(self):
-        if self.__ticket is None:
-            return 0
+    @measured
+    def totals(self):
+        """
+        Returns the subtotal, taxes and total of the current ticket at once.
+        """
+        if self.ticket is None:
+            return TicketTotals.zero
         else:
-            return self.ticket.subtotal
+            return self.ticket.totals()
+    
+    @property
+    def subtotal(self):
+        return self.totals.subtotal
     
     @property
     def taxes(self):
-        if self.ticket is None:
-            return 0
-        else:
-            return self.ticket.taxes
+        return self.totals.taxes
     
     @property
     def total(self):
-        if self.__ticket is None:
-            return 0
-        else:
-            return self.ticket.total
+        return self.totals.total
+    
+    @measured
+    def reconcile_totals(self):
+        """
+        Repairs the running totals of all tickets that drifted from their ticketlines.
+        """
+        return Ticket.reconcile_totals()
     
     # Ticket Operations
     
+    def _update_ticketline(self, tl, data):
+        """
+        Applies data to the ticketline and moves the running totals of its
+        ticket by the difference, in a single commit.
+        """
+        old_ticket, before = tl.ticket, tl.line_totals()
+        old_product, old_amount = tl.product_id, tl.amount
+        
+        for field, value in data.iteritems():
+            setattr(tl, field, value)
+        
+        # The reservation of the line moves along with its product and amount
+        new_product = product_id(data['product']) if 'product' in data else old_product
+        new_amount = 1 if tl.amount is None else tl.amount
+        
+        if old_ticket is not None:
+            old_ticket.add_line_totals(TicketTotals.zero-before)
+            self.stock.reserve(old_product, -old_amount)
+        if tl.ticket is not None:
+            tl.ticket.add_line_totals(tl.line_totals())
+            self.stock.reserve(new_product, new_amount)
+
+        self._save(tl)
+        self.invalidate(self.LINES, self.TOTALS)
+    
+    def _delete_ticketline(self, tl):
+        if tl.ticket is not None:
+            tl.ticket.add_line_totals(TicketTotals.zero-tl.line_totals())
+            self.stock.reserve(tl.product_id, -tl.amount)
+        self._remove(tl)
+        self.invalidate(self.LINES, self.TOTALS)
+    
+    @measured
+    @retry_on_conflict
+    @journaled
     def add_ticketline(self, data):
         if self.ticket is None:
             raise TicketSelectionException()
         
         tl = TicketLine()
-        tl.update(**data)
+        self._update_ticketline(tl, data)
         
         self.update_taxes()
         
         return tl
     
+    @measured
+    @retry_on_conflict
+    @journaled
     def edit_ticketline(self, tl, data):
         if self.ticket is None:
             raise TicketSelectionException()
         
-        tl.update(**data)
+        self._update_ticketline(tl, data)
         
         self.update_taxes()
     
+    @measured
+    @retry_on_conflict
+    @journaled
     def remove_ticketline(self, tl):
         if self.ticket is None:
             raise TicketSelectionException()
         
-        tl.delete()
+        self._delete_ticketline(tl)
         
         self.update_taxes()
     
+    @measured
+    @retry_on_conflict
+    @journaled
     def set_ticketline_amount(self, tl, amount, force=False):
         if self.ticket is None:
             raise TicketSelectionException()
         
         new_amount = amount
         if new_amount>0:
-            if not force:
-                p = tl.product
-                if p is not None and p.in_stock and p.quantity<new_amount:
-                    raise ValueError("Amount in stock is smaller than set amount")
-            tl.update(amount=new_amount)
+            if not force and not self.stock.allows(tl.product_id, new_amount, current=tl.amount):
+                raise ValueError("Amount in stock is smaller than set amount")
+            self._update_ticketline(tl, {'amount': new_amount})
         else:
-            tl.delete()
+            self._delete_ticketline(tl)
         
         self.update_taxes()
     
+    @measured
     def add_product(self, p):
+        self.add_products([(p, 1)])
+    
+    @measured
+    @retry_on_conflict
+    @journaled
+    def add_products(self, items):
+        """
+        Adds a batch of (product, amount) pairs to the ticket, with one commit
+        and one taxes update for the whole batch.
+        """
         if self.ticket is None:
             raise TicketSelectionException()
         
-        self.ticket.add_product(p)
-        self.ticket.update()
+        for p, amount in items:
+            self.ticket.add_product(p, amount, convert=self.conversions.convert)
+            self.stock.reserve(product_id(p), amount)
+        self._save(self.ticket)
+        self.invalidate(self.LINES, self.TOTALS)
         
         self.update_taxes()
     
+    @measured
     def update_taxes(self):
-        dispatcher.send(signal='update-taxes', sender='sales', manager=self)
+        responses = dispatcher.send(signal='update-taxes', sender='sales', manager=self)
+        
+        # Tax handlers write TicketLine.taxes directly, so the running totals
+        # are synced again, but only if someone actually handled the signal
+        if responses and self.ticket is not None and self.ticket.sync_totals():
+            self._save(self.ticket)
+            self.invalidate(self.LINES, self.TOTALS)
     
     # Ticket Tools
     
@@ -139,6 +386,20 @@ class SalesManager(object):
         session = cbpos.database.session()
         return session.query(Currency)
     
+    __default_currency = None
+    @property
+    def default_currency(self):
+        """
+        Returns the default currency, looked up once until the currencies change.
+        """
+        if self.__default_currency is None:
+            self.__default_currency = currency.default
+        return self.__default_currency
+    
+    def forget_default_currency(self, **kwargs):
+        self.__default_currency = None
+        self.invalidate(self.CURRENCIES)
+    
     __currency = None
     @property
     def currency(self):
@@ -147,37 +408,54 @@ class SalesManager(object):
         elif self.ticket is not None:
             return self.ticket.currency
         else:
-            return currency.default
+            return self.default_currency
     
     @currency.setter
     def currency(self, c):
         if c is None:
-            self.__currency = currency.default
-            return
+            self.__currency = self.default_currency
+        else:
+            self.__currency = c
         
-        self.__currency = c
+        self.invalidate(self.CURRENCIES, self.LINES, self.TOTALS)
     
-    def currency_display(self, value, src=None, dst=None):
+    def _display_currencies(self, src, dst):
         if dst is None:
             dst = self.currency
         
-        if src is None:
-            if self.ticket is None:
-                return dst.format(value)
-            
+        if src is None and self.ticket is not None:
             src = self.ticket.currency
         
-        if src == dst:
+        return src, dst
+    
+    def currency_display(self, value, src=None, dst=None):
+        src, dst = self._display_currencies(src, dst)
+        
+        if src is None or src == dst:
             return dst.format(value)
         else:
-            return dst.format(currency.convert(value, src, dst))
+            return dst.format(self.conversions.convert(value, src, dst))
     
+    def display_many(self, values, src=None, dst=None):
+        """
+        Formats a whole column of values at once, looking up the rate only once.
+        """
+        src, dst = self._display_currencies(src, dst)
+        
+        if src is not None:
+            values = self.conversions.convert_many(values, src, dst)
+        return [dst.format(value) for value in values]
+    
+    @measured
     def update_ticket_currency(self):
         if self.ticket is not None:
-            orig_c = self.currency
+            # Converts the ticket to the display currency
+            orig_c, c = self.ticket.currency, self.currency
             for tl in self.ticket.ticketlines:
                 tl.update(sell_price=currency.convert(tl.sell_price, orig_c, c))
+            self.ticket.sync_totals()
             self.ticket.update(currency=c)
+            self.invalidate(self.CURRENCIES, self.LINES, self.TOTALS)
             
             self.update_taxes()
     
@@ -193,12 +471,15 @@ class SalesManager(object):
             return self.ticket.discount
     
     @discount.setter
+    @retry_on_conflict
+    @journaled
     def discount(self, value):
         # Value is in the range [0-100]
         if self.ticket is None:
             raise TicketSelectionException()
         
-        self.ticket.update(discount=value)
+        self._save(self.ticket, discount=value)
+        self.invalidate(self.DISCOUNT, self.TOTALS)
     
     def list_customers(self):
         pass
@@ -211,14 +492,36 @@ class SalesManager(object):
             return self.ticket.customer
     
     @customer.setter
+    @retry_on_conflict
+    @journaled
     def customer(self, c):
         if self.ticket is None:
             raise TicketSelectionException()
         
         if c is not None:
-            self.ticket.update(customer=c, discount=c.discount)
+            self._save(self.ticket, customer=c, discount=c.discount)
         else:
-            self.ticket.update(customer=None, discount=0)
+            self._save(self.ticket, customer=None, discount=0)
+        self.invalidate(self.CUSTOMER, self.DISCOUNT, self.TOTALS)
+    
+    # Stock
+    
+    def available(self, p):
+        """
+        Returns the quantity of the product not reserved by the open tickets,
+        or None if it is not kept in stock.
+        """
+        return self.stock.available(product_id(p))
+    
+    @measured
+    def stock_shortages(self):
+        """
+        Checks the lines of the current ticket against the stock, in one query.
+        Returns a Shortage for every product that would be oversold.
+        """
+        if self.ticket is None:
+            return []
+        return shortages(self.ticket)
     
     # Payment
     
@@ -226,4 +529,178 @@ class SalesManager(object):
     def payment_methods(self):
         # TODO: The payment options should be configurable, and depend on permissions
         return ('cash', 'cheque', 'card', 'voucher', 'free', 'debt')
-    
\ No newline at end of file
+    
+    # Debts
+    
+    @property
+    def settlement_methods(self):
+        return ('cash', 'cheque', 'voucher')
+    
+    @measured
+    def settle_customer_debt(self, customer, method):
+        """
+        Marks all the outstanding debt tickets of the customer as paid with
+        the given method, in one UPDATE and one commit.
+        Returns the number of settled tickets.
+        """
+        with unit_of_work() as session:
+            CustomerBalance.reset(customer)
+            count = session.query(Ticket) \
+                    .filter((Ticket.customer_id == customer.id) & \
+                            (Ticket.payment_method == 'debt') & \
+                            (Ticket.date_paid == None)) \
+                    .update({Ticket.payment_method: unicode(method),
+                             Ticket.date_paid: func.now(),
+                             Ticket.version: Ticket.version + 1},
+                            synchronize_session=False)
+        return count
+    
+    def customer_debt(self, customer):
+        """
+        Returns the current debt of the customer, in the customer's currency.
+        """
+        return CustomerBalance.of(customer)
+    
+    @measured
+    def is_debt_allowed(self, customer, amount, src=None):
+        """
+        Returns True if amount (in the ticket currency by default) can be
+        added to the debt of the customer without exceeding its maximum.
+        """
+        if customer.max_debt is None:
+            return True
+        
+        if src is None:
+            src = self.ticket.currency
+        
+        amount = currency.convert(amount, src, customer.currency)
+        return self.customer_debt(customer) + amount <= customer.max_debt
+    
+    @measured
+    def rebuild_customer_balances(self):
+        """
+        Recomputes the debt ledger of all customers from the tickets.
+        """
+        return CustomerBalance.rebuild()
+    
+    # Reporting
+    
+    @measured
+    def backfill_daily_rollup(self):
+        """
+        Rebuilds the daily sales rollup from the whole history.
+        """
+        return DailyRollup.backfill()
+    
+    # Import
+    
+    @measured
+    def import_tickets(self, tickets, move_stock=False, update_summaries=True):
+        """
+        Imports tickets from another terminal or system in bulk, e.g. from
+        read_csv or read_jsonl.
+        If update_summaries is set, the imported tickets are added to the
+        customer balances and the daily rollup in the same transaction.
+        Returns the number of imported tickets.
+        """
+        count = import_tickets(tickets, move_stock=move_stock, update_summaries=update_summaries)
+        # Imported open tickets reserve stock, and closed ones may have moved it
+        self.stock.invalidate()
+        self.invalidate(self.TICKETS, self.CATALOG)
+        return count
+    
+    # Journal
+    
+    journal = None
+    journal_state = None
+    
+    def open_journal(self, path, terminal=None, sync_interval=0.2, sync_every=50,
+                     group_size=20, group_interval=2.0):
+        """
+        Replays the operations of the journal at path that did not reach the
+        database, then journals the following operations in it.
+        From then on the operations only flush their changes, and they are
+        committed in groups of group_size operations, or group_interval seconds
+        after the previous commit, or when a ticket is closed.
+        If an operation cannot be replayed, the journal is closed and kept as
+        it is, and JournalReplayException is raised.
+        Returns the number of replayed operations.
+        """
+        session = cbpos.database.session()
+        
+        self.journal_state = JournalState.of(terminal or socket.gethostname()[:64])
+        session.commit()
+        
+        self.journal = Journal(path, sync_interval=sync_interval, sync_every=sync_every)
+        self.journal_group_size = group_size
+        self.journal_group_interval = group_interval
+        self.journal_pending = 0
+        self.journal_committed_at = time.time()
+        
+        count = self.replay_journal()
+        if count:
+            logger.info('Replayed %d operations from the journal %s', count, path)
+        
+        self._journal_committed(session)
+        event.listen(session, 'after_commit', self._journal_committed)
+        return count
+    
+    def replay_journal(self):
+        """
+        Applies again the journaled operations that did not reach the database,
+        e.g. after a conflict rolled them back, then empties the journal.
+        If an operation cannot be replayed, the journal is closed and kept as
+        it is, and JournalReplayException is raised.
+        Returns the number of replayed operations.
+        """
+        try:
+            count = replay(self)
+        except JournalReplayException:
+            self.journal.close()
+            self.journal = None
+            raise
+        self.journal.truncate()
+        return count
+    
+    def _journal_committed(self, session):
+        if self.journal is None:
+            return
+        # The sequence number of the last operation was committed with it
+        self.journal_pending = 0
+        self.journal_committed_at = time.time()
+        if not self.journal.replaying:
+            self.journal.truncate()
+    
+    def journal_operation_done(self):
+        self.journal_pending += 1
+        if self.journal_pending >= self.journal_group_size:
+            self.commit_journal()
+        else:
+            self.sync_journal()
+    
+    def sync_journal(self):
+        """
+        Fsyncs the journal, and commits the grouped operations, if due.
+        To be called periodically.
+        """
+        if self.journal is None:
+            return
+        self.journal.sync_due()
+        if self.journal_pending and time.time()-self.journal_committed_at >= self.journal_group_interval:
+            self.commit_journal()
+    
+    def commit_journal(self):
+        """
+        Commits the grouped operations now.
+        """
+        if self.journal is not None and self.journal_pending:
+            cbpos.database.session().commit()
+    
+    def close_journal(self):
+        if self.journal is None:
+            return
+        session = cbpos.database.session()
+        session.commit()
+        event.remove(session, 'after_commit', self._journal_committed)
+        self.journal.close()
+        self.journal = None
@@ -0,0 +1,138 @@
+from collections import namedtuple
+
+from sqlalchemy import func, case, select
+from sqlalchemy.orm.attributes import instance_state
+
+import cbpos
+
+from cbmod.sales.models import Ticket, TicketLine
+
+from cbmod.stock.models.product import Product
+
+logger = cbpos.get_logger(__name__)
+
+Shortage = namedtuple('Shortage', 'product_id requested available')
+
+def product_id(p):
+    """
+    Returns the id of the product without loading it again if it is expired.
+    """
+    if p is None:
+        return None
+    key = instance_state(p).key
+    return key[1][0] if key is not None else p.id
+
+class StockLedger(object):
+    """
+    Quantities of the in-stock products reserved by the lines of open tickets,
+    along with their stock, by product id.
+    It is seeded with one grouped query the first time it is needed, then
+    kept up to date by the SalesManager on every line change, so checking
+    the availability of a product does not load it.
+    Products that are not kept in stock are not tracked.
+    """
+
+    def __init__(self):
+        self.reserved = None
+        self.stock = {}
+
+    def invalidate(self):
+        """
+        Drops everything, to be loaded again from the database when needed,
+        e.g. after a rollback or after other terminals changed the stock.
+        """
+        self.reserved = None
+        self.stock.clear()
+
+    def load(self):
+        session = cbpos.database.session()
+        rows = session.query(TicketLine.product_id, Product.quantity, func.sum(TicketLine.amount)) \
+                    .join(TicketLine.ticket) \
+                    .join(TicketLine._product) \
+                    .filter(~Ticket.closed & Product.in_stock) \
+                    .group_by(TicketLine.product_id, Product.quantity)
+
+        self.reserved = {}
+        self.stock = {}
+        for pid, quantity, amount in rows:
+            self.reserved[pid] = amount or 0
+            self.stock[pid] = quantity
+
+    def _stock(self, pid):
+        try:
+            return self.stock[pid]
+        except KeyError:
+            session = cbpos.database.session()
+            row = session.query(Product.in_stock, Product.quantity).filter(Product.id == pid).first()
+            quantity = row.quantity if row is not None and row.in_stock else None
+            self.stock[pid] = quantity
+            return quantity
+
+    def available(self, pid):
+        """
+        Returns the quantity of the product that is not reserved yet,
+        or None if it is not kept in stock.
+        """
+        if self.reserved is None:
+            self.load()
+        quantity = self._stock(pid)
+        if quantity is None:
+            return None
+        return quantity - self.reserved.get(pid, 0)
+
+    def allows(self, pid, amount, current=0):
+        """
+        Returns True if a line of the product can hold amount, given that it
+        reserves current already.
+        """
+        if pid is None:
+            return True
+        available = self.available(pid)
+        return available is None or available + current >= amount
+
+    def reserve(self, pid, amount):
+        """
+        Moves the reservation of the product by amount, which is negative to release it.
+        """
+        if pid is not None and self.reserved is not None:
+            self.reserved[pid] = self.reserved.get(pid, 0) + amount
+
+    def consume(self, amounts):
+        """
+        Takes the {product id: amount} of a closed ticket out of both the
+        stock and the reservations, as Ticket.move_stock did in the database.
+        """
+        for pid, amount in amounts.iteritems():
+            self.reserve(pid, -amount)
+            if self.stock.get(pid) is not None:
+                self.stock[pid] -= amount
+
+def line_amounts(ticket):
+    """
+    Returns the amounts of the lines of the ticket summed by product id.
+    """
+    amounts = {}
+    for tl in ticket.ticketlines:
+        if tl.product_id is not None:
+            amounts[tl.product_id] = amounts.get(tl.product_id, 0) + tl.amount
+    return amounts
+
+def shortages(ticket):
+    """
+    Checks all the lines of the ticket against the stock in the database at
+    once, counting what the other open tickets reserved first.
+    Returns a Shortage for every product that would be oversold.
+    """
+    session = cbpos.database.session()
+    own = func.sum(case([(TicketLine.ticket_id == ticket.id, TicketLine.amount)], else_=0))
+    products = select([TicketLine.product_id]).where(TicketLine.ticket_id == ticket.id)
+
+    rows = session.query(TicketLine.product_id, Product.quantity, own, func.sum(TicketLine.amount)) \
+                .join(TicketLine.ticket) \
+                .join(TicketLine._product) \
+                .filter(~Ticket.closed & Product.in_stock & TicketLine.product_id.in_(products)) \
+                .group_by(TicketLine.product_id, Product.quantity)
+
+    return [Shortage(pid, requested, quantity - (reserved - requested))
+            for pid, quantity, requested, reserved in rows
+            if requested > quantity - (reserved - requested)]
@@ -0,0 +1,28 @@
+class ScanBatch(object):
+    """
+    Collects scanned products and merges the repeated ones into a single
+    amount, keeping the order in which each product was first scanned.
+    """
+    
+    def __init__(self):
+        self.entries = []
+        self.by_product = {}
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def add(self, p, amount=1):
+        entry = self.by_product.get(p.id)
+        if entry is None:
+            entry = self.by_product[p.id] = [p, 0]
+            self.entries.append(entry)
+        entry[1] += amount
+    
+    def drain(self):
+        """
+        Returns the collected (product, amount) pairs and empties the batch.
+        """
+        items = [tuple(entry) for entry in self.entries]
+        self.entries = []
+        self.by_product = {}
+        return items
@@ -0,0 +1,19 @@
+from contextlib import contextmanager
+
+import cbpos
+
+@contextmanager
+def unit_of_work():
+    """
+    Runs the block in a single transaction of the current session.
+    It is committed once when the block ends, or rolled back entirely if the
+    block raises, in which case the objects of the session are expired back
+    to their stored state and the exception propagates.
+    """
+    session = cbpos.database.session()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
@@ -0,0 +1,248 @@
+import threading
+import Queue
+from collections import namedtuple
+
+from sqlalchemy.orm import object_mapper, class_mapper
+from sqlalchemy.orm.exc import UnmappedInstanceError
+
+import cbpos
+
+from cbmod.sales.models import Ticket
+
+from cbmod.currency.models import Currency
+
+logger = cbpos.get_logger(__name__)
+
+PageData = namedtuple('PageData', 'ticket_id dirty tickets currencies ticket')
+
+class Future(object):
+    """
+    Result of an operation queued on a DatabaseWorker.
+    """
+    
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+    
+    def done(self):
+        return self._event.is_set()
+    
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Operation did not finish in time')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+    
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Operation did not finish in time')
+        return self._exception
+    
+    def add_done_callback(self, fn):
+        """
+        Calls fn(future) when the operation finishes, on the worker thread,
+        or right away if it is already finished.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+    
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception('Error in a database worker callback')
+
+class DatabaseWorker(object):
+    """
+    Runs database operations one after the other on a dedicated thread.
+    The session returned by cbpos.database.session() is scoped to the thread,
+    so the operations use the worker's own session. ORM objects must not be
+    passed between threads, pass their ids instead.
+    """
+    
+    def __init__(self, name='sales-database'):
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs) and returns its Future.
+        """
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+    
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+    
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                cbpos.database.session().rollback()
+                future._finish(exception=e)
+            else:
+                future._finish(result=result)
+        
+        cbpos.database.session().close()
+
+class ObjectRef(object):
+    """
+    Thread-safe reference to a mapped object, by class and primary key.
+    """
+    
+    def __init__(self, obj):
+        self.cls = type(obj)
+        self.pk = tuple(object_mapper(obj).primary_key_from_instance(obj))
+    
+    def resolve(self, session):
+        return session.query(self.cls).get(self.pk)
+
+def _ref(value):
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        # Named tuples like Shortage hold plain values
+        return value
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_ref(v) for v in value)
+    elif isinstance(value, dict):
+        return dict((k, _ref(v)) for k, v in value.iteritems())
+    try:
+        return ObjectRef(value)
+    except UnmappedInstanceError:
+        return value
+
+def _resolve(session, value):
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_resolve(session, v) for v in value)
+    elif isinstance(value, dict):
+        return dict((k, _resolve(session, v)) for k, v in value.iteritems())
+    elif isinstance(value, ObjectRef):
+        return value.resolve(session)
+    return value
+
+class AsyncSalesManager(object):
+    """
+    Runs SalesManager operations on a DatabaseWorker instead of the calling thread.
+    The worker keeps its own SalesManager whose ticket follows the selected
+    ticket id. Results are handed back as ObjectRefs, and the parts of the
+    page the operation invalidated are passed on to the local manager.
+    What the page renders is loaded on the worker as well, see load().
+    """
+    
+    def __init__(self, manager, worker=None):
+        self.manager = manager
+        self.worker = worker if worker is not None else DatabaseWorker()
+        self.pending = 0
+        self.ticket_id = None
+        self._remote = None
+    
+    def select(self, ticket_id):
+        """
+        Makes ticket_id the current ticket of the following operations,
+        without loading it.
+        """
+        self.ticket_id = ticket_id
+        self.manager.invalidate(*self.manager.REGIONS)
+    
+    def call(self, name, *args, **kwargs):
+        """
+        Queues the SalesManager operation `name` and returns its Future,
+        which results in (result, invalidated regions). The name of a
+        property, e.g. discount, sets it to the single argument.
+        """
+        args = [_ref(a) for a in args]
+        kwargs = dict((k, _ref(v)) for k, v in kwargs.iteritems())
+        self.pending += 1
+        return self.worker.submit(self._call, self.ticket_id, name, args, kwargs)
+    
+    def load(self, dirty):
+        """
+        Queues loading what the page renders for the dirty regions: the open
+        tickets, the currencies and the current ticket following the
+        ticket_load_plan. Returns a Future resulting in (PageData, no regions).
+        The objects of the PageData are loaded in a session of their own that
+        is closed right away, so they are detached and rendering them does
+        not query from the calling thread.
+        """
+        self.pending += 1
+        return self.worker.submit(self._load, self.ticket_id, frozenset(dirty))
+    
+    def _remote_manager(self):
+        from cbmod.sales.controllers.manager import SalesManager
+        
+        if self._remote is None:
+            self._remote = SalesManager()
+        return self._remote
+    
+    def _call(self, ticket_id, name, args, kwargs):
+        # Runs on the worker thread
+        session = cbpos.database.session()
+        remote = self._remote_manager()
+        
+        current = remote.ticket
+        if (current.id if current is not None else None) != ticket_id:
+            remote.ticket = session.query(Ticket).get(ticket_id) if ticket_id is not None else None
+        
+        args = [_resolve(session, a) for a in args]
+        kwargs = dict((k, _resolve(session, v)) for k, v in kwargs.iteritems())
+        if isinstance(getattr(type(remote), name), property):
+            setattr(remote, name, *args)
+            result = None
+        else:
+            result = getattr(remote, name)(*args, **kwargs)
+        return _ref(result), remote.take_dirty()
+    
+    def _load(self, ticket_id, dirty):
+        # Runs on the worker thread
+        remote = self._remote_manager()
+        tickets = remote.list_ticket_summaries() if remote.TICKETS in dirty else None
+        
+        session = cbpos.database.session.session_factory()
+        try:
+            currencies = session.query(Currency).all() if remote.CURRENCIES in dirty else None
+            ticket = session.query(Ticket).options(*remote.ticket_load_plan) \
+                            .filter(Ticket.id == ticket_id).first() if ticket_id is not None else None
+        finally:
+            session.close()
+        return PageData(ticket_id, dirty, tickets, currencies, ticket), frozenset()
+    
+    def finish(self, future):
+        """
+        Applies the outcome of an operation to the local side.
+        To be called on the thread of the local manager once the future is done.
+        Returns the result as handed back by the worker, or raises its exception.
+        """
+        self.pending -= 1
+        
+        # The local session is not expired: the page renders what load()
+        # hands back, and expiring would make it query on this thread
+        result, dirty = future.result()
+        self.manager.invalidate(*dirty)
+        if dirty & set((self.manager.LINES, self.manager.TICKETS)):
+            # The reservations moved on the worker's ledger
+            self.manager.stock.invalidate()
+        return result
@@ -3,10 +3,12 @@ from pydispatch import dispatcher
 import cbpos
 from cbpos.modules import BaseModuleLoader
 
+logger = cbpos.get_logger(__name__)
+
 class ModuleLoader(BaseModuleLoader):
     def load_models(self):
-        from cbmod.sales.models import Ticket, TicketLine
-        return [Ticket, TicketLine]
+        from cbmod.sales.models import Ticket, TicketLine, CustomerBalance, DailyRollup, JournalState
+        return [Ticket, TicketLine, CustomerBalance, DailyRollup, JournalState]
 
     def test_models(self):
         from cbmod.sales.models import Ticket, TicketLine
@@ -39,26 +41,36 @@ class ModuleLoader(BaseModuleLoader):
         
         [session.add(tl) for tl in (tl1, tl2, tl3, tl4, tl5)]
         session.commit()
+        
+        # The lines were added directly, fill in the running totals
+        Ticket.reconcile_totals()
 
     def init(self):
         dispatcher.send(signal='printing-register-function', sender='sales',
                         function='print-ticket')
         
+        from cbmod.sales.controllers.latency import dump_latency
+        dispatcher.connect(dump_latency, signal='sales-dump-latency', weak=False)
+        
+        from cbmod.sales.models import Ticket, TicketLine
+        from cbmod.sales.models.schema import add_missing_columns, create_missing_indexes
+        try:
+            added = add_missing_columns([Ticket.__table__, TicketLine.__table__])
+            if ('tickets', 'total') in added:
+                # The running totals start at 0, compute them once
+                Ticket.reconcile_totals()
+        except Exception:
+            logger.exception('Could not add the missing sales columns')
+        try:
+            create_missing_indexes([Ticket.__table__, TicketLine.__table__])
+        except Exception:
+            logger.exception('Could not create the missing sales indexes')
+        
         return True
 
     def menu(self):
         from cbpos.interface import MenuItem
-        from cbmod.sales.views import SalesPage # DebtsPage
-        
-        """
-                 MenuItem('debts', parent='main',
-                          label=cbpos.tr.sales_('Debts'),
-                          icon=cbpos.res.sales('images/menu-debts.png'),
-                          rel=0,
-                          priority=4,
-                          page=DebtsPage
-                          )
-        """
+        from cbmod.sales.views import SalesPage, DebtsPage
         
         return [[],
                 [MenuItem('sales', parent='main',
@@ -67,6 +79,13 @@ class ModuleLoader(BaseModuleLoader):
                           rel=0,
                           priority=5,
                           page=SalesPage
+                          ),
+                 MenuItem('debts', parent='main',
+                          label=cbpos.tr.sales_('Debts'),
+                          icon=cbpos.res.sales('images/menu-sales.png'),
+                          rel=0,
+                          priority=4,
+                          page=DebtsPage
                           )
                  ]
                 ]
@@ -12,4 +12,30 @@ class ModuleMetadata(BaseModuleMetadata):
         ('stock', '0.1'),
         ('customer', '0.1'),
     )
-    config_defaults = tuple()
+    config_defaults = (
+        ('mod.sales', {
+                       # Run the database operations of the sales page on a worker thread
+                       'async': '',
+                       # Scans arriving within this many milliseconds are added at once
+                       'scan_window': '150',
+                       # Fail if rendering the loaded ticket issues lazy loads
+                       'assert_render_queries': '',
+                       # Log and signal the queries of every sales operation
+                       'query_stats': '',
+                       # Warn about operations going over their number of queries, e.g. "add_product=4"
+                       'query_budgets': '',
+                       # Log the sales page actions taking longer than this many milliseconds
+                       'slow_action_ms': '',
+                       # File the latency percentiles are written to, instead of the log
+                       'latency_dump': '',
+                       # Journal file of the sales operations; when set, their commits are grouped
+                       'journal': '',
+                       # The journal is fsynced at most this many milliseconds after an operation
+                       'journal_sync_ms': '200',
+                       # Grouped operations are committed after this many of them...
+                       'journal_group': '20',
+                       # ...or this many milliseconds after the previous commit
+                       'journal_group_ms': '2000',
+                       }
+         ),
+    )
@@ -1,2 +1,6 @@
 from .ticket import Ticket
-from .ticketline import TicketLine
\ No newline at end of file
+from .ticketline import TicketLine
+from .totals import TicketTotals
+from .balance import CustomerBalance
+from .rollup import DailyRollup
+from .journal import JournalState
\ No newline at end of file
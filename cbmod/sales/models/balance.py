@@ -0,0 +1,95 @@
+import cbpos
+
+import cbmod.base.models.common as common
+
+import cbmod.currency.controllers as currency
+from cbmod.currency.models import CurrencyValue
+
+from sqlalchemy import func, Column, Integer, ForeignKey
+from sqlalchemy.orm import relationship, backref
+
+class CustomerBalance(cbpos.database.Base, common.Item):
+    """
+    Running balance of the unpaid debt tickets of a customer, in the
+    currency of the customer.
+    """
+    __tablename__ = 'customer_balances'
+
+    customer_id = Column(Integer, ForeignKey('customers.id'), primary_key=True)
+    balance = Column(CurrencyValue(), nullable=False, default=0)
+
+    customer = relationship("Customer", backref=backref("balance_entry", uselist=False))
+
+    @classmethod
+    def of(cls, customer):
+        """
+        Returns the current balance of the customer, reading a single row.
+        """
+        session = cbpos.database.session()
+        balance = session.query(cls.balance).filter(cls.customer_id == customer.id).scalar()
+        return balance if balance is not None else 0
+
+    @classmethod
+    def add(cls, customer, amount):
+        """
+        Adds amount to the balance of the customer, relative to its current
+        value in the database. Does not commit.
+        If another terminal creates the row meanwhile, the flush raises
+        IntegrityError and the whole transaction has to be run again, like
+        for DailyRollup.add.
+        """
+        session = cbpos.database.session()
+        count = session.query(cls).filter(cls.customer_id == customer.id) \
+                    .update({cls.balance: cls.balance + amount}, synchronize_session=False)
+        if count == 0:
+            session.add(cls(customer_id=customer.id, balance=amount))
+            session.flush()
+
+    @classmethod
+    def reset(cls, customer):
+        """
+        Clears the balance of the customer. Does not commit.
+        """
+        session = cbpos.database.session()
+        session.query(cls).filter(cls.customer_id == customer.id) \
+                .update({cls.balance: 0}, synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recomputes the balances of all customers from their unpaid debt tickets.
+        Only one row per customer and ticket currency is read from the
+        database to do it.
+        """
+        from cbmod.customer.models import Customer
+        from cbmod.currency.models import Currency
+        from cbmod.sales.models.ticket import Ticket
+        
+        session = cbpos.database.session()
+        
+        debts = session.query(Ticket.customer_id, Ticket.currency_id, func.sum(Ticket.total)) \
+                    .filter((Ticket.payment_method == 'debt') & \
+                            (Ticket.date_paid == None) & \
+                            (Ticket.customer_id != None)) \
+                    .group_by(Ticket.customer_id, Ticket.currency_id).all()
+        
+        currencies = dict((c.id, c) for c in session.query(Currency))
+        customer_ids = set(customer_id for customer_id, _, _ in debts)
+        customers = dict((c.id, c) for c in session.query(Customer).filter(Customer.id.in_(customer_ids))) \
+                        if customer_ids else {}
+        
+        balances = {}
+        for customer_id, currency_id, total in debts:
+            c = customers[customer_id]
+            value = currency.convert(total or 0, currencies[currency_id], c.currency)
+            balances[customer_id] = balances.get(customer_id, 0) + value
+        
+        session.query(cls).delete(synchronize_session=False)
+        session.add_all([cls(customer_id=customer_id, balance=balance)
+                         for customer_id, balance in balances.iteritems()])
+        session.commit()
+        
+        return len(balances)
+
+    def __repr__(self):
+        return "<CustomerBalance of Customer #%s>" % (self.customer_id,)
@@ -0,0 +1,30 @@
+import cbpos
+
+from sqlalchemy import Column, Integer, String
+
+class JournalState(cbpos.database.Base):
+    """
+    Sequence number of the last journaled operation of a terminal that
+    reached the database. It is written in the same transaction as the
+    operation itself, so replaying the journal never applies one twice.
+    """
+    __tablename__ = 'sales_journal_state'
+
+    terminal = Column(String(64), primary_key=True)
+    seq = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def of(cls, terminal):
+        """
+        Returns the state of the terminal, creating it if needed. Does not commit.
+        """
+        session = cbpos.database.session()
+        state = session.query(cls).get(terminal)
+        if state is None:
+            state = cls(terminal=terminal, seq=0)
+            session.add(state)
+            session.flush()
+        return state
+
+    def __repr__(self):
+        return "<JournalState %s at %s>" % (self.terminal, self.seq)
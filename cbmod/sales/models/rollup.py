@@ -0,0 +1,122 @@
+import cbpos
+
+from cbmod.currency.models import CurrencyValue
+
+from sqlalchemy import func, Column, Integer, String, Date, ForeignKey, UniqueConstraint
+
+class DailyRollup(cbpos.database.Base):
+    """
+    Sales aggregated by day, user, payment method, currency and product.
+    Totals include the ticket discount.
+    """
+    __tablename__ = 'sales_daily_rollup'
+    __table_args__ = (
+        UniqueConstraint('day', 'user_id', 'payment_method', 'currency_id', 'product_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    payment_method = Column(String(16), nullable=True)
+    currency_id = Column(String(3), ForeignKey('currencies.id'), nullable=True)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=True)
+    amount = Column(Integer, nullable=False, default=0)
+    subtotal = Column(CurrencyValue(), nullable=False, default=0)
+    taxes = Column(CurrencyValue(), nullable=False, default=0)
+    total = Column(CurrencyValue(), nullable=False, default=0)
+
+    @classmethod
+    def add_ticket(cls, ticket):
+        """
+        Adds the lines of a closed ticket to the rollup, one statement per
+        product of the ticket. Does not commit.
+        """
+        from cbmod.sales.models.ticketline import TicketLine
+        
+        session = cbpos.database.session()
+        
+        lines = session.query(TicketLine.product_id,
+                              func.sum(TicketLine.amount),
+                              func.sum(TicketLine.subtotal),
+                              func.sum(TicketLine.taxes),
+                              func.sum(TicketLine.total)) \
+                    .filter(TicketLine.ticket_id == ticket.id) \
+                    .group_by(TicketLine.product_id).all()
+        
+        key = dict(day=ticket.date_close.date(),
+                   user_id=ticket.user_id,
+                   payment_method=ticket.payment_method,
+                   currency_id=ticket.currency_id)
+        
+        for product_id, amount, subtotal, taxes, total in lines:
+            values = dict(amount=amount, subtotal=subtotal, taxes=taxes,
+                          total=total*(100-ticket.discount)/100)
+            cls.add(dict(key, product_id=product_id), values)
+
+    @classmethod
+    def add(cls, key, values):
+        """
+        Adds values to the row of key, creating it if needed. Does not commit.
+        If another terminal creates the same row meanwhile, the insert raises
+        IntegrityError and the whole transaction has to be run again, as
+        retry_on_conflict does for the SalesManager operations.
+        """
+        session = cbpos.database.session()
+        
+        query = session.query(cls)
+        for field, value in key.iteritems():
+            query = query.filter(getattr(cls, field) == value)
+        
+        count = query.update(dict((getattr(cls, field), getattr(cls, field) + value)
+                                  for field, value in values.iteritems()),
+                             synchronize_session=False)
+        if count == 0:
+            session.execute(cls.__table__.insert(), [dict(key, **values)])
+
+    @classmethod
+    def backfill(cls, batch_size=1000):
+        """
+        Rebuilds the whole rollup from the closed tickets. The aggregated rows
+        are streamed and inserted in batches.
+        Returns the number of rollup rows.
+        """
+        from cbmod.sales.models.ticket import Ticket
+        from cbmod.sales.models.ticketline import TicketLine
+        
+        session = cbpos.database.session()
+        
+        day = func.date(Ticket.date_close, type_=Date)
+        rows = session.query(day, Ticket.user_id, Ticket.payment_method,
+                             Ticket.currency_id, TicketLine.product_id,
+                             func.sum(TicketLine.amount),
+                             func.sum(TicketLine.subtotal),
+                             func.sum(TicketLine.taxes),
+                             func.sum(TicketLine.total*(100-Ticket.discount)/100.0)) \
+                    .join(TicketLine.ticket) \
+                    .filter(Ticket.date_close != None) \
+                    .group_by(day, Ticket.user_id, Ticket.payment_method,
+                              Ticket.currency_id, TicketLine.product_id) \
+                    .execution_options(stream_results=True).yield_per(batch_size)
+        
+        fields = ('day', 'user_id', 'payment_method', 'currency_id', 'product_id',
+                  'amount', 'subtotal', 'taxes', 'total')
+        
+        session.query(cls).delete(synchronize_session=False)
+        
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(dict(zip(fields, row)))
+            if len(batch) >= batch_size:
+                session.execute(cls.__table__.insert(), batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            session.execute(cls.__table__.insert(), batch)
+            count += len(batch)
+        
+        session.commit()
+        return count
+
+    def __repr__(self):
+        return "<DailyRollup %s>" % (self.day,)
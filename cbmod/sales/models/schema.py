@@ -0,0 +1,91 @@
+import re
+
+import sqlalchemy
+from sqlalchemy.engine import reflection
+
+import cbpos
+
+logger = cbpos.get_logger(__name__)
+
+def _sqlalchemy_version():
+    return tuple(int(n) for n in re.findall(r'\d+', sqlalchemy.__version__)[:3])
+
+def partial(where):
+    """
+    Returns the Index keyword arguments restricting it to the rows matching
+    the where clause, on the backends that support partial indexes.
+    The other backends get a full index on the same columns.
+    """
+    kwargs = {'postgresql_where': where}
+    if _sqlalchemy_version() >= (0, 9, 9):
+        kwargs['sqlite_where'] = where
+    return kwargs
+
+def create_missing_indexes(tables):
+    """
+    Creates the declared indexes of the tables that are missing from the
+    database, for installations created before they were declared.
+    Returns the names of the created indexes.
+    """
+    session = cbpos.database.session()
+    bind = session.get_bind(None)
+    inspector = reflection.Inspector.from_engine(bind)
+    
+    existing_tables = set(inspector.get_table_names())
+    
+    created = []
+    for table in tables:
+        if table.name not in existing_tables:
+            # It will be created along with its indexes
+            continue
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info('Creating index %s on %s', index.name, table.name)
+                index.create(bind)
+                created.append(index.name)
+    return created
+
+def _literal(value):
+    if isinstance(value, basestring):
+        return "'%s'" % (value.replace("'", "''"),)
+    elif isinstance(value, bool):
+        return str(int(value))
+    return str(value)
+
+def add_missing_columns(tables):
+    """
+    Adds the declared columns of the tables that are missing from the
+    database, for installations created before they were declared. Existing
+    rows get the scalar default of the column.
+    Returns the added columns as (table name, column name).
+    """
+    session = cbpos.database.session()
+    bind = session.get_bind(None)
+    inspector = reflection.Inspector.from_engine(bind)
+    quote = bind.dialect.identifier_preparer.quote
+    
+    existing_tables = set(inspector.get_table_names())
+    
+    added = []
+    for table in tables:
+        if table.name not in existing_tables:
+            # It will be created along with its columns
+            continue
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (quote(table.name), quote(column.name),
+                                                      column.type.compile(dialect=bind.dialect))
+            if column.default is not None and column.default.is_scalar:
+                ddl += ' DEFAULT %s' % (_literal(column.default.arg),)
+                if not column.nullable:
+                    ddl += ' NOT NULL'
+            elif not column.nullable:
+                logger.warning('Cannot add the column %s.%s without a default', table.name, column.name)
+                continue
+            logger.info('Adding column %s to %s', column.name, table.name)
+            bind.execute(ddl)
+            added.append((table.name, column.name))
+    return added
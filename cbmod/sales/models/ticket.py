@@ -3,11 +3,14 @@ import cbpos
 import cbmod.base.models.common as common
 
 import cbmod.currency.controllers as currency
+from cbmod.currency.models import CurrencyValue
 
 from cbmod.stock.models.product import Product
 from cbmod.sales.models.ticketline import TicketLine
+from cbmod.sales.models.totals import TicketTotals
+from cbmod.sales.models.schema import partial
 
-from sqlalchemy import func, cast, Table, Column, Integer, String, Float, Boolean, Enum, DateTime, MetaData, ForeignKey
+from sqlalchemy import func, cast, select, Table, Column, Index, Integer, String, Float, Boolean, Enum, DateTime, MetaData, ForeignKey
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method, Comparator
 
@@ -24,11 +27,20 @@ class Ticket(cbpos.database.Base, common.Item):
     currency_id = Column(String(3), ForeignKey('currencies.id'))
     customer_id = Column(Integer, ForeignKey('customers.id'), nullable=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    # Running sums of the ticketlines, before the ticket discount
+    _subtotal = Column('subtotal', CurrencyValue(), nullable=False, default=0)
+    _taxes = Column('taxes', CurrencyValue(), nullable=False, default=0)
+    _total = Column('total', CurrencyValue(), nullable=False, default=0)
+    # Checked and incremented on every flush, so that concurrent changes
+    # from another terminal fail instead of being overwritten
+    version = Column(Integer, nullable=False, default=1)
 
     currency = relationship("Currency", backref="tickets")
     customer = relationship("Customer", backref="tickets")
     user = relationship("User", backref="tickets")
 
+    __mapper_args__ = {'version_id_col': version}
+
     @hybrid_property
     def paid(self):
         return self.date_paid is not None
@@ -59,11 +71,7 @@ class Ticket(cbpos.database.Base, common.Item):
         session = cbpos.database.session()
         if value:
             self.date_close = func.now()
-            result = session.query(Product, TicketLine.amount).filter((TicketLine.ticket == self) & \
-                                                        (TicketLine.product_id == Product.id) & \
-                                                        Product.in_stock).all()
-            for p, amount in result:
-                p.quantity_out(amount)
+            self.move_stock()
         else:
             self.date_close = None
         session.commit()
@@ -72,38 +80,145 @@ class Ticket(cbpos.database.Base, common.Item):
     def closed(cls):
         return cls.date_close != None
 
+    def close(self, method, paid=True):
+        """
+        Pays and closes the ticket and takes its products out of stock.
+        Does not commit, so that it can be part of a larger transaction.
+        """
+        self.payment_method = method
+        self.paid = paid
+        self.date_close = func.now()
+        self.move_stock()
+
+    def move_stock(self):
+        """
+        Takes the amounts of all the ticketlines out of stock in one UPDATE.
+        Lines of the same product are summed first, and the quantity is
+        decremented relative to its current value, so tickets closing at the
+        same time on other terminals cannot overwrite each other.
+        Does not commit.
+        """
+        session = cbpos.database.session()
+        session.flush()
+        
+        amount = select([func.sum(TicketLine.amount)]) \
+                    .where((TicketLine.ticket_id == self.id) & \
+                           (TicketLine.product_id == Product.id)) \
+                    .as_scalar()
+        products = select([TicketLine.product_id]).where(TicketLine.ticket_id == self.id)
+        
+        session.query(Product).filter(Product.in_stock & Product.id.in_(products)) \
+                .update({Product.quantity: Product.quantity - amount},
+                        synchronize_session=False)
+
+    def totals(self):
+        """
+        Returns the subtotal, taxes and total of the ticket as a TicketTotals,
+        read from the running totals.
+        """
+        lines = TicketTotals(self._subtotal or 0, self._taxes or 0, self._total or 0)
+        return lines.discounted(self.discount)
+
+    def compute_line_totals(self):
+        """
+        Sums the ticketlines again, without the ticket discount.
+        If the ticketlines are already loaded they are summed in memory,
+        otherwise all three figures come from a single aggregate query.
+        """
+        if 'ticketlines' in self.__dict__ and all(tl.id is not None for tl in self.ticketlines):
+            lines = TicketTotals.zero
+            for tl in self.ticketlines:
+                lines += tl.line_totals()
+            return lines
+        
+        session = cbpos.database.session()
+        row = session.query(func.sum(TicketLine.subtotal),
+                            func.sum(TicketLine.taxes),
+                            func.sum(TicketLine.total)) \
+                    .filter(TicketLine.ticket == self) \
+                    .group_by(TicketLine.ticket_id).first()
+        if row is None:
+            return TicketTotals.zero
+        else:
+            return TicketTotals(*(v if v is not None else 0 for v in row))
+
+    def add_line_totals(self, delta):
+        """
+        Moves the running totals by the TicketTotals delta of a ticketline change.
+        Does not commit.
+        """
+        self._subtotal = (self._subtotal or 0) + delta.subtotal
+        self._taxes = (self._taxes or 0) + delta.taxes
+        self._total = (self._total or 0) + delta.total
+
+    def sync_totals(self):
+        """
+        Recomputes the running totals from the ticketlines.
+        Returns True if they had drifted. Does not commit.
+        """
+        lines = self.compute_line_totals()
+        current = TicketTotals(self._subtotal, self._taxes, self._total)
+        if current == lines:
+            return False
+        self._subtotal, self._taxes, self._total = lines
+        return True
+
+    @classmethod
+    def reconcile_totals(cls):
+        """
+        Verifies the running totals of all tickets against their ticketlines
+        and repairs the ones that drifted, in one UPDATE statement.
+        Returns the number of repaired tickets.
+        """
+        session = cbpos.database.session()
+        
+        def line_sum(expr):
+            return select([func.coalesce(func.sum(expr), 0)]) \
+                    .where(TicketLine.ticket_id == cls.id).as_scalar()
+        
+        subtotal = line_sum(TicketLine.subtotal)
+        taxes = line_sum(TicketLine.taxes)
+        total = line_sum(TicketLine.total)
+        
+        stmt = cls.__table__.update() \
+                .where((cls._subtotal != subtotal) | (cls._taxes != taxes) | (cls._total != total)) \
+                .values(subtotal=subtotal, taxes=taxes, total=total, version=cls.version+1)
+        result = session.execute(stmt)
+        session.commit()
+        return result.rowcount
+
     @hybrid_property
     def taxes(self):
         """
         Returns the sum of taxes of all ticketlines
         """
-        session = cbpos.database.session()
-        total_taxes = session.query(func.sum(TicketLine.taxes)).filter(TicketLine.ticket == self).one()[0]
-        return total_taxes if total_taxes is not None else 0 
+        return self.totals().taxes
+
+    @taxes.expression
+    def taxes(cls):
+        return cls._taxes
 
     @hybrid_property
     def total(self):
         """
         Returns the total, including taxes and discounts.
         """
-        session = cbpos.database.session()
-        
-        query = session.query(func.sum(TicketLine.total)).filter(TicketLine.ticket == self)
-        total = query.one()[0]
-        
-        if total is None:
-            return 0
-        else:
-            return total*(100-self.discount)/100
+        return self.totals().total
+    
+    @total.expression
+    def total(cls):
+        return cls._total*(100-cls.discount)/100.0
     
     @hybrid_property
     def subtotal(self):
         """
         Returns the subtotal, excluding any taxes or discounts, e.g. net total.
         """
-        session = cbpos.database.session()
-        total = session.query(func.sum(TicketLine.subtotal)).filter(TicketLine.ticket == self).one()[0]
-        return total if total is not None else 0
+        return self.totals().subtotal
+    
+    @subtotal.expression
+    def subtotal(cls):
+        return cls._subtotal
     
     @hybrid_property
     def display(self):
@@ -113,21 +228,90 @@ class Ticket(cbpos.database.Base, common.Item):
     def display(self):
         return '#' + cast(self.id, String)
     
-    def add_product(self, p):
+    def _product_lines(self):
+        """
+        Returns the index of the unedited ticketlines of this ticket by product id.
+        It is built on first use, from memory if the ticketlines are loaded,
+        and then kept in sync by add_product and the TicketLine setters.
+        """
+        index = getattr(self, '_product_line_index', None)
+        if index is not None:
+            return index
+        
+        if 'ticketlines' in self.__dict__:
+            lines = self.ticketlines
+        else:
+            session = cbpos.database.session()
+            lines = session.query(TicketLine).filter((TicketLine.ticket_id == self.id) & \
+                                                     (TicketLine.product_id != None) & \
+                                                     ~TicketLine.is_edited
+                                                     )
+        index = {}
+        for tl in lines:
+            product_id = tl.product_id
+            if product_id is None and tl.product is not None:
+                # Not flushed yet
+                product_id = tl.product.id
+            if product_id is not None and not tl.is_edited:
+                index.setdefault(product_id, tl)
+        self._product_line_index = index
+        return index
+
+    def index_line(self, tl, p):
+        """
+        Registers tl as the unedited line of product p, unless there is one already.
+        """
+        index = getattr(self, '_product_line_index', None)
+        if index is not None:
+            index.setdefault(p.id, tl)
+
+    def forget_line(self, tl):
+        """
+        Removes tl from the index of unedited lines.
+        """
+        index = getattr(self, '_product_line_index', None)
+        if index is not None:
+            for product_id, line in index.items():
+                if line is tl:
+                    del index[product_id]
+
+    def add_product(self, p, amount=1, convert=None):
+        # The currency module is shadowed by the relationship in the class body
+        if convert is None:
+            convert = currency.convert
         session = cbpos.database.session()
-        tls = session.query(TicketLine).filter((TicketLine.ticket_id == self.id) & \
-                                               (TicketLine.product == p) & \
-                                               ~TicketLine.is_edited
-                                               )
-        tl = tls.first()
+        index = self._product_lines()
+        tl = index.get(p.id)
+        if tl is not None and (tl not in session or tl.is_edited):
+            # The line was deleted or edited behind the index's back
+            del index[p.id]
+            tl = None
+        
         if tl is None:
-            sell_price = currency.convert(p.price, p.currency, self.currency)
-            tl = TicketLine(product=p, sell_price=sell_price)
+            sell_price = convert(p.price, p.currency, self.currency)
+            tl = TicketLine(product=p, sell_price=sell_price, amount=amount)
             self.ticketlines.append(tl)
+            self.add_line_totals(tl.line_totals())
+            index[p.id] = tl
             return tl
         else:
-            tl.amount = tl.amount+1
+            before = tl.line_totals()
+            tl.amount = tl.amount+amount
+            self.add_line_totals(tl.line_totals()-before)
             return tl
     
     def __repr__(self):
         return "<Ticket %s>" % (self.id,)
+
+_c = Ticket.__table__.c
+
+# Open tickets, for list_tickets. Where partial indexes are not supported,
+# ix_tickets_date_close serves the date_close IS NULL lookups instead.
+Index('ix_tickets_open', _c.id, **partial(_c.date_close == None))
+
+# Outstanding debts of a customer
+Index('ix_tickets_customer_debt', _c.customer_id,
+      **partial((_c.payment_method == 'debt') & (_c.date_paid == None)))
+
+# Closed tickets by period, for reporting
+Index('ix_tickets_date_close', _c.date_close)
@@ -2,12 +2,14 @@ import cbpos
 
 import cbmod.base.models.common as common
 
-from sqlalchemy import func, Table, Column, Integer, String, Float, Boolean, MetaData, ForeignKey
+from sqlalchemy import func, Table, Column, Index, Integer, String, Float, Boolean, MetaData, ForeignKey
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method, Comparator
 
 from cbmod.currency.models import CurrencyValue
 
+from cbmod.sales.models.totals import TicketTotals
+
 class TicketLine(cbpos.database.Base, common.Item):
     __tablename__ = 'ticketlines'
 
@@ -20,17 +22,21 @@ class TicketLine(cbpos.database.Base, common.Item):
     _is_edited = Column('is_edited', Boolean, nullable=False, default=False)
     ticket_id = Column(Integer, ForeignKey('tickets.id'), nullable=False)
     product_id = Column(Integer, ForeignKey('products.id'))
+    # Checked and incremented on every flush, like Ticket.version
+    version = Column(Integer, nullable=False, default=1)
     
     ticket = relationship("Ticket", backref=backref("ticketlines", cascade="all, delete-orphan"))
     _product = relationship("Product", backref="ticketlines")
 
+    __mapper_args__ = {'version_id_col': version}
+
     @hybrid_property
     def display(self):
-        return unicode(self.ticket.id)+'/'+unicode(self.id)
+        return unicode(self.ticket_id)+'/'+unicode(self.id)
     
     @display.expression
     def display(self):
-        return func.concat(self.ticket.id, '/', self.id)
+        return func.concat(self.ticket_id, '/', self.id)
 
     @hybrid_property
     def product(self):
@@ -38,6 +44,7 @@ class TicketLine(cbpos.database.Base, common.Item):
     
     @product.setter
     def product(self, p):
+        self._unindex()
         if p is None:
             self._product = None
             self._is_edited = False
@@ -48,6 +55,9 @@ class TicketLine(cbpos.database.Base, common.Item):
             #self._sell_price = p.sell_price
             self._product = p
             self._is_edited = False
+            ticket = self.__dict__.get('ticket')
+            if ticket is not None:
+                ticket.index_line(self, p)
 
     @hybrid_property
     def description(self):
@@ -58,6 +68,7 @@ class TicketLine(cbpos.database.Base, common.Item):
         self._description = value
         if self._product is not None and not self._is_edited and value != self._product.name:
             self._is_edited = True
+            self._unindex()
 
     @hybrid_property
     def sell_price(self):
@@ -68,6 +79,7 @@ class TicketLine(cbpos.database.Base, common.Item):
         self._sell_price = value
         if self._product is not None and not self._is_edited and value != self._product.sell_price:
             self._is_edited = True
+            self._unindex()
 
     @hybrid_property
     def is_edited(self):
@@ -90,7 +102,8 @@ class TicketLine(cbpos.database.Base, common.Item):
     
     @total.expression
     def total(self):
-        return (self.taxes + self.sell_price * self.amount) * (100-self.discount)/100
+        # The decimal divisor keeps SQLite from dividing integers
+        return (self.taxes + self.sell_price * self.amount) * (100-self.discount)/100.0
     
     @hybrid_property
     def subtotal(self):
@@ -103,5 +116,35 @@ class TicketLine(cbpos.database.Base, common.Item):
     def subtotal(self):
         return self.amount*self.sell_price
 
+    def _unindex(self):
+        """
+        Drops this line from its ticket's index of unedited lines, if loaded.
+        """
+        ticket = self.__dict__.get('ticket')
+        if ticket is not None:
+            ticket.forget_line(self)
+
+    def line_totals(self):
+        """
+        Returns the subtotal, taxes and total of this line as a TicketTotals.
+        Column defaults are assumed for the values that are not set yet.
+        """
+        amount = 1 if self.amount is None else self.amount
+        sell_price = self.sell_price or 0
+        taxes = self.taxes or 0
+        discount = self.discount or 0
+        
+        subtotal = amount*sell_price
+        return TicketTotals(subtotal, taxes, (taxes + subtotal) * (100-discount)/100)
+
     def __repr__(self):
-        return "<TicketLine %s in Ticket #%s>" % (self.id, self.ticket.id)
+        return "<TicketLine %s in Ticket #%s>" % (self.id, self.ticket_id)
+
+_c = TicketLine.__table__.c
+
+# Backs the lookup of the unedited line of a product in Ticket.add_product,
+# and the aggregates by ticket_id as its leading column
+Index('ix_ticketlines_ticket_product', _c.ticket_id, _c.product_id, _c.is_edited)
+
+# Lines by product, for stock movements and reporting
+Index('ix_ticketlines_product', _c.product_id)
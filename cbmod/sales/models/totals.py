@@ -0,0 +1,21 @@
+from collections import namedtuple
+
+class TicketTotals(namedtuple('TicketTotals', 'subtotal taxes total')):
+    """
+    Snapshot of the money figures of a ticket (or of a single ticketline).
+    """
+    __slots__ = ()
+
+    def __add__(self, other):
+        return TicketTotals(*(a+b for a, b in zip(self, other)))
+
+    def __sub__(self, other):
+        return TicketTotals(*(a-b for a, b in zip(self, other)))
+
+    def discounted(self, discount):
+        """
+        Returns the same snapshot with the discount [0-100] applied on the total.
+        """
+        return self._replace(total=self.total*(100-discount)/100)
+
+TicketTotals.zero = TicketTotals(0, 0, 0)
@@ -0,0 +1,3 @@
+from .report import SalesReport, ReportRow, ProductRow, SummaryRow, x_report, z_report
+from .rollup import RollupReport, RollupRow
+from .export import write_csv, write_jsonl
@@ -0,0 +1,41 @@
+import csv
+import json
+import datetime
+import decimal
+
+def _plain(value):
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def write_csv(rows, fileobj):
+    """
+    Writes report rows (namedtuples) to fileobj as CSV, one row at a time.
+    Returns the number of written rows.
+    """
+    writer = csv.writer(fileobj)
+    count = 0
+    for row in rows:
+        if count == 0:
+            writer.writerow(row._fields)
+        writer.writerow([_plain(value) for value in row])
+        count += 1
+    return count
+
+def write_jsonl(rows, fileobj, section=None):
+    """
+    Writes report rows (namedtuples) to fileobj as JSON lines, one row at a time.
+    Returns the number of written rows.
+    """
+    count = 0
+    for row in rows:
+        data = dict((field, _plain(value)) for field, value in zip(row._fields, row))
+        if section is not None:
+            data['section'] = section
+        fileobj.write(json.dumps(data) + '\n')
+        count += 1
+    return count
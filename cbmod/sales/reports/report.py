@@ -0,0 +1,116 @@
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import func
+
+import cbpos
+
+from cbmod.sales.models import Ticket, TicketLine
+
+logger = cbpos.get_logger(__name__)
+
+ReportRow = namedtuple('ReportRow', 'key currency tickets subtotal taxes total')
+ProductRow = namedtuple('ProductRow', 'key currency amount subtotal taxes total')
+SummaryRow = namedtuple('SummaryRow', 'currency tickets subtotal taxes total average')
+
+class SalesReport(object):
+    """
+    Report over the tickets closed in the period [start, end).
+    Every figure is aggregated by the database and the rows are streamed
+    with server-side cursors where the backend supports them, so memory
+    use does not grow with the size of the history.
+    Amounts are never summed across currencies: each row is per currency.
+    The queries run in the given session, by default the one of cbpos.
+    """
+    
+    def __init__(self, start, end, batch_size=1000, session=None):
+        self.start = start
+        self.end = end
+        self.batch_size = batch_size
+        self.session = session
+    
+    def _session(self):
+        if self.session is not None:
+            return self.session
+        return cbpos.database.session()
+    
+    def _stream(self, query):
+        return query.execution_options(stream_results=True).yield_per(self.batch_size)
+    
+    def _in_period(self, query):
+        return query.filter((Ticket.date_close >= self.start) & (Ticket.date_close < self.end))
+    
+    def _by_ticket(self, key):
+        session = self._session()
+        query = session.query(key, Ticket.currency_id,
+                              func.count(Ticket.id),
+                              func.sum(Ticket.subtotal),
+                              func.sum(Ticket.taxes),
+                              func.sum(Ticket.total))
+        query = self._in_period(query).group_by(key, Ticket.currency_id).order_by(key, Ticket.currency_id)
+        for row in self._stream(query):
+            yield ReportRow(*row)
+    
+    def by_payment_method(self):
+        return self._by_ticket(Ticket.payment_method)
+    
+    def by_user(self):
+        return self._by_ticket(Ticket.user_id)
+    
+    def by_currency(self):
+        return self._by_ticket(Ticket.currency_id)
+    
+    def by_customer(self):
+        return self._by_ticket(Ticket.customer_id)
+    
+    def by_product(self):
+        session = self._session()
+        # The line total, with the ticket discount applied
+        total = TicketLine.total*(100-Ticket.discount)/100.0
+        query = session.query(TicketLine.product_id, Ticket.currency_id,
+                              func.sum(TicketLine.amount),
+                              func.sum(TicketLine.subtotal),
+                              func.sum(TicketLine.taxes),
+                              func.sum(total)) \
+                        .join(TicketLine.ticket)
+        query = self._in_period(query).group_by(TicketLine.product_id, Ticket.currency_id) \
+                        .order_by(TicketLine.product_id, Ticket.currency_id)
+        for row in self._stream(query):
+            yield ProductRow(*row)
+    
+    def summary(self):
+        """
+        Yields the ticket count, totals and average basket per currency.
+        """
+        for row in self.by_currency():
+            average = row.total/row.tickets if row.tickets else 0
+            yield SummaryRow(row.currency, row.tickets, row.subtotal, row.taxes, row.total, average)
+    
+    def sections(self):
+        """
+        Yields (name, rows) for every part of the report.
+        """
+        return (('summary', self.summary()),
+                ('payment_method', self.by_payment_method()),
+                ('user', self.by_user()),
+                ('currency', self.by_currency()),
+                ('customer', self.by_customer()),
+                ('product', self.by_product()))
+
+def x_report(now=None):
+    """
+    Returns the report of the current day so far.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    start = datetime.datetime.combine(now.date(), datetime.time())
+    return SalesReport(start, now)
+
+def z_report(day=None):
+    """
+    Returns the report of a whole day, by default today.
+    """
+    if day is None:
+        day = datetime.date.today()
+    start = datetime.datetime.combine(day, datetime.time())
+    return SalesReport(start, start + datetime.timedelta(days=1))
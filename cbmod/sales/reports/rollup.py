@@ -0,0 +1,48 @@
+from collections import namedtuple
+
+from sqlalchemy import func
+
+import cbpos
+
+from cbmod.sales.models import DailyRollup
+
+RollupRow = namedtuple('RollupRow', 'key currency amount subtotal taxes total')
+
+class RollupReport(object):
+    """
+    Report over the days [start, end) read from the daily rollup instead of
+    the tickets, for dashboards and end-of-day figures.
+    Amounts are never summed across currencies: each row is per currency.
+    """
+    
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+    
+    def _by(self, key):
+        session = cbpos.database.session()
+        query = session.query(key, DailyRollup.currency_id,
+                              func.sum(DailyRollup.amount),
+                              func.sum(DailyRollup.subtotal),
+                              func.sum(DailyRollup.taxes),
+                              func.sum(DailyRollup.total)) \
+                        .filter((DailyRollup.day >= self.start) & (DailyRollup.day < self.end)) \
+                        .group_by(key, DailyRollup.currency_id) \
+                        .order_by(key, DailyRollup.currency_id)
+        for row in query:
+            yield RollupRow(*row)
+    
+    def by_day(self):
+        return self._by(DailyRollup.day)
+    
+    def by_payment_method(self):
+        return self._by(DailyRollup.payment_method)
+    
+    def by_user(self):
+        return self._by(DailyRollup.user_id)
+    
+    def by_currency(self):
+        return self._by(DailyRollup.currency_id)
+    
+    def by_product(self):
+        return self._by(DailyRollup.product_id)
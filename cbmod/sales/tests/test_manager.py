@@ -0,0 +1,66 @@
+import datetime
+import unittest
+
+from sqlalchemy import create_engine
+
+import cbpos
+
+import cbmod.auth.models
+import cbmod.currency.models
+import cbmod.customer.models
+import cbmod.stock.models.product
+from cbmod.sales.models import Ticket, TicketLine, DailyRollup
+from cbmod.sales.controllers import SalesManager
+
+class CloseTicketTest(unittest.TestCase):
+    """
+    Closes tickets through the SalesManager on an SQLite database, the
+    backend of the tills, bound to the session of cbpos.
+    """
+    
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        cbpos.database.Base.metadata.create_all(self.engine)
+        cbpos.database.session.remove()
+        cbpos.database.session.configure(bind=self.engine)
+        self.session = cbpos.database.session()
+        self.manager = SalesManager()
+    
+    def tearDown(self):
+        cbpos.database.session.remove()
+        self.engine.dispose()
+    
+    def add_ticket(self, ticket_id, sell_price):
+        now = datetime.datetime.now()
+        self.session.execute(Ticket.__table__.insert(),
+                             dict(id=ticket_id, date_open=now, discount=0, currency_id='USD',
+                                  subtotal=sell_price, taxes=0, total=sell_price, version=1))
+        self.session.execute(TicketLine.__table__.insert(),
+                             dict(ticket_id=ticket_id, description='', sell_price=sell_price,
+                                  amount=1, discount=0, taxes=0, is_edited=False, version=1))
+        self.session.commit()
+        return self.session.query(Ticket).get(ticket_id)
+    
+    def close(self, t):
+        self.manager.ticket = t
+        self.manager.close_ticket('cash', True, True)
+    
+    def test_close_creates_rollup_row(self):
+        t = self.add_ticket(1, 10)
+        self.close(t)
+        
+        self.assertTrue(self.session.query(Ticket).get(1).closed)
+        row, = self.session.query(DailyRollup).all()
+        self.assertEqual(row.amount, 1)
+        self.assertAlmostEqual(float(row.total), 10)
+    
+    def test_close_updates_rollup_row(self):
+        self.close(self.add_ticket(1, 10))
+        self.close(self.add_ticket(2, 5))
+        
+        row, = self.session.query(DailyRollup).all()
+        self.assertEqual(row.amount, 2)
+        self.assertAlmostEqual(float(row.total), 15)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import datetime
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import cbpos
+
+import cbmod.auth.models
+import cbmod.currency.models
+import cbmod.customer.models
+import cbmod.stock.models.product
+from cbmod.sales.models import Ticket, TicketLine
+from cbmod.sales.reports import SalesReport
+
+class SalesReportTest(unittest.TestCase):
+    """
+    Runs the report queries against an in-memory SQLite database, which
+    divides integers like the production backends may do.
+    """
+    
+    day = datetime.datetime(2014, 3, 1, 12)
+    
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        cbpos.database.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        
+        # A ticket of 11.00 with a discount of 15%
+        self.add_ticket(1, discount=15, lines=[dict(sell_price=11, amount=1, discount=0, product_id=1)])
+        # A ticket with a single line of 1.00 discounted by 50%
+        self.add_ticket(2, discount=0, lines=[dict(sell_price=1, amount=1, discount=50, product_id=2)])
+        self.report = SalesReport(self.day.replace(hour=0), self.day.replace(hour=23), session=self.session)
+    
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+    
+    def add_ticket(self, ticket_id, discount, lines):
+        subtotal = sum(l['sell_price']*l['amount'] for l in lines)
+        total = sum(l['sell_price']*l['amount']*(100-l['discount'])/100.0 for l in lines)
+        self.session.execute(Ticket.__table__.insert(),
+                             dict(id=ticket_id, date_open=self.day, date_close=self.day,
+                                  payment_method='cash', discount=discount, currency_id='USD',
+                                  subtotal=subtotal, taxes=0, total=total, version=1))
+        for line in lines:
+            self.session.execute(TicketLine.__table__.insert(),
+                                 dict(line, ticket_id=ticket_id, description='', taxes=0,
+                                      is_edited=False, version=1))
+        self.session.commit()
+    
+    def test_by_currency_applies_discount(self):
+        row, = self.report.by_currency()
+        self.assertEqual(row.tickets, 2)
+        self.assertAlmostEqual(float(row.total), 9.35 + 0.5)
+    
+    def test_by_product_applies_discounts(self):
+        totals = dict((row.key, float(row.total)) for row in self.report.by_product())
+        self.assertAlmostEqual(totals[1], 9.35)
+        self.assertAlmostEqual(totals[2], 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,2 +1,2 @@
-#from .debts import DebtsPage
+from .debts import DebtsPage
 from .sales import SalesPage
@@ -1,90 +1,120 @@
-import wx
+from PySide import QtGui
 
-import pos
+import cbpos
 
-from pos.modules.sales.models.ticket import Ticket
+from cbmod.sales.controllers import SalesManager
 
-from pos.modules.customer.windows import CustomerCatalog
+from cbmod.customer.views.dialogs import CustomerChooserDialog
 
-from ..dialogs import PayDialog
+from cbmod.base.views import BasePage
 
-class DebtsPanel(wx.Panel):
-    def _init_sizers(self):
-        self.formSizer = wx.GridBagSizer(hgap=0, vgap=0)
-        self.formSizer.Add(self.customerLbl, (0, 0))
-        self.formSizer.Add(self.customerTxt, (0, 1))
-        self.formSizer.Add(self.currentDebtLbl, (1, 0))
-        self.formSizer.Add(self.currentDebtTxt, (1, 1))
-        self.formSizer.Add(self.maxDebtLbl, (2, 0))
-        self.formSizer.Add(self.maxDebtTxt, (2, 1))
-        self.formSizer.AddGrowableCol(1, 1)
-
-        self.controlSizer = wx.BoxSizer(orient=wx.HORIZONTAL)
-        self.controlSizer.Add(self.payBtn, 0, flag=wx.ALIGN_RIGHT)
+class DebtsPage(BasePage):
+    def __init__(self):
+        super(DebtsPage, self).__init__()
         
-        self.mainSizer = wx.BoxSizer(orient=wx.VERTICAL)
-        self.mainSizer.Add(self.customerList, 1, border=5, flag=wx.EXPAND | wx.ALL)
-        self.mainSizer.AddSizer(self.formSizer, 1, border=5, flag=wx.EXPAND | wx.ALL)
-        self.mainSizer.AddSizer(self.controlSizer, 0, border=5, flag=wx.EXPAND | wx.ALL)
-
-        self.SetSizer(self.mainSizer)
-
-    def _init_main(self):
-        self.customerLbl = wx.StaticText(self, -1, label='Customer')
-        self.customerTxt = wx.TextCtrl(self, -1, style=wx.TE_READONLY)
-
-        self.currentDebtLbl = wx.StaticText(self, -1, label='Current Debt')
-        self.currentDebtTxt = wx.TextCtrl(self, -1, style=wx.TE_READONLY)
-
-        self.maxDebtLbl = wx.StaticText(self, -1, label='Max Debt')
-        self.maxDebtTxt = wx.TextCtrl(self, -1, style=wx.TE_READONLY)
+        self.manager = SalesManager()
         
-        self.customerList = CustomerCatalog(self)
-        self.customerList.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.OnCustomerCatalogItemActivate)
-
-        self.payBtn = wx.Button(self, -1, label='Pay')
-        self.payBtn.Bind(wx.EVT_BUTTON, self.OnPayButton)
-    
-    def __init__(self, parent):
-        wx.Panel.__init__(self, parent, -1, style=wx.TAB_TRAVERSAL)
-
-        self._init_main()
-        self._init_sizers()
+        self.customer = QtGui.QLineEdit()
+        self.customer.setReadOnly(True)
+        self.customer.setPlaceholderText(cbpos.tr.sales_('No customer selected'))
+        
+        self.customerBtn = QtGui.QPushButton(cbpos.tr.sales_('Choose'))
+        
+        self.currentDebt = QtGui.QLineEdit()
+        self.currentDebt.setReadOnly(True)
+        
+        self.maxDebt = QtGui.QLineEdit()
+        self.maxDebt.setReadOnly(True)
+        
+        self.method = QtGui.QComboBox()
+        self.method.setEditable(False)
+        
+        self.payBtn = QtGui.QPushButton(cbpos.tr.sales_('Pay'))
+        
+        customerLayout = QtGui.QHBoxLayout()
+        customerLayout.addWidget(self.customer)
+        customerLayout.addWidget(self.customerBtn)
+        
+        customerLayout.setStretch(0, 1)
+        customerLayout.setStretch(1, 0)
+        
+        form = QtGui.QFormLayout()
+        form.setSpacing(10)
+        
+        rows = ((cbpos.tr.sales_('Customer'), customerLayout),
+                (cbpos.tr.sales_('Current Debt'), self.currentDebt),
+                (cbpos.tr.sales_('Max Debt'), self.maxDebt),
+                (cbpos.tr.sales_('Payment'), self.method))
+        
+        [form.addRow(*row) for row in rows]
+        
+        buttons = QtGui.QHBoxLayout()
+        buttons.addStretch(1)
+        buttons.addWidget(self.payBtn)
+        
+        layout = QtGui.QVBoxLayout()
+        layout.addLayout(form)
+        layout.addStretch(1)
+        layout.addLayout(buttons)
+        
+        self.setLayout(layout)
+        
+        # Signals
+        self.customerBtn.pressed.connect(self.onCustomerButton)
+        self.payBtn.pressed.connect(self.onPayButton)
         
         self.setCustomer(None)
 
+    def populate(self):
+        labels = {'cash': cbpos.tr.sales_('Cash'),
+                  'cheque': cbpos.tr.sales_('Cheque'),
+                  'voucher': cbpos.tr.sales_('Voucher')}
+        
+        self.method.clear()
+        for method in self.manager.settlement_methods:
+            self.method.addItem(labels.get(method, method), method)
+        
+        self.setCustomer(self.customerValue)
+
     def setCustomer(self, c):
-        self.customer = c
+        self.customerValue = c
         if c is not None:
-            self.current_debt = self.customer.debt
-            self.max_debt = self.customer.max_debt
-            
-            self.customerTxt.SetValue(self.customer.name)
-            self.currentDebtTxt.SetValue(self.customer.currency.format(self.current_debt))
-            self.maxDebtTxt.SetValue('[None]' if self.max_debt is None else self.customer.currency.format(self.max_debt))
-            self.payBtn.Enable(True)
+            cc = c.currency
+            self.customer.setText(c.name)
+            self.currentDebt.setText(cc.format(self.manager.customer_debt(c)))
+            self.maxDebt.setText('' if c.max_debt is None else cc.format(c.max_debt))
+            self.payBtn.setEnabled(True)
         else:
-            self.current_debt = None
-            self.max_debt = None
-            
-            self.customerTxt.SetValue('[None]')
-            self.currentDebtTxt.SetValue('[None]')
-            self.maxDebtTxt.SetValue('[None]')
-            self.payBtn.Enable(False)
+            self.customer.setText('')
+            self.currentDebt.setText('')
+            self.maxDebt.setText('')
+            self.payBtn.setEnabled(False)
 
-    def OnCustomerCatalogItemActivate(self, event):
-        event.Skip()
-        c = self.customerList.GetValue()
-        self.setCustomer(c)
+    def onCustomerButton(self):
+        dlg = CustomerChooserDialog()
+        dlg.setCustomer(self.customerValue)
+        dlg.exec_()
+        if dlg.result() == QtGui.QDialog.Accepted:
+            self.setCustomer(dlg.customer)
 
-    def OnPayButton(self, event):
-        event.Skip()
-        dlg = PayDialog(None, self.current_debt, self.customer.currency, self.customer, disabled=['debt'])
-        ret = dlg.ShowModal()
-        if ret == wx.ID_OK:
-            session = pos.database.session()
-            unsettled_tickets = session.query(Ticket).filter(Ticket.customer == self.customer,
-                                                             Ticket.payment_method == 'debt',
-                                                             ~Ticket.paid).all()
-            for t in unsettled_tickets:
-                t.pay(*dlg.payment)
+    def onPayButton(self):
+        c = self.customerValue
+        if c is None:
+            return
+        
+        method = self.method.itemData(self.method.currentIndex())
+        if method is None:
+            return
+        
+        message = cbpos.tr.sales_('Settle all the debts of {customer}?').format(customer=c.name)
+        reply = QtGui.QMessageBox.question(self, cbpos.tr.sales_('Debts'), message,
+                                           QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+        if reply != QtGui.QMessageBox.Yes:
+            return
+        
+        count = self.manager.settle_customer_debt(c, method)
+        
+        message = cbpos.tr.sales_('{count} tickets settled.').format(count=count)
+        QtGui.QMessageBox.information(self, cbpos.tr.sales_('Debts'), message)
+        
+        self.setCustomer(c)
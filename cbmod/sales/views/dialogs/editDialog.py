@@ -1,7 +1,7 @@
 from PySide import QtGui
 
 class EditDialog(QtGui.QDialog):
-    def __init__(self, data):
+    def __init__(self, data, manager=None, reserved=0):
         super(EditDialog, self).__init__()
 
         self.description = QtGui.QLineEdit()
@@ -45,6 +45,19 @@ class EditDialog(QtGui.QDialog):
         self.setLayout(form)
 
         self.data = data
+        # The stock reservations of the manager are used if given, and the
+        # edited line already holds `reserved` of its product
+        self.manager = manager
+        self.reserved = reserved
+
+    def available(self, p):
+        """
+        Returns the amount of the product this line can hold, or None if unlimited.
+        """
+        if self.manager is not None:
+            available = self.manager.available(p)
+            return available + self.reserved if available is not None else None
+        return p.quantity if p.in_stock else None
 
     def populate(self):
         self.description.setText(self.data['description'])
@@ -57,14 +70,13 @@ class EditDialog(QtGui.QDialog):
             self.max.setValue(0)
         else:
             self.product.setText(p.name)
-            if p.in_stock:
-                self.max.setValue(p.quantity)
-            else:
-                self.max.setValue(0)
+            available = self.available(p)
+            self.max.setValue(available if available is not None else 0)
     
     def onOkButton(self):
         p = self.data['product']
-        if p is not None and p.in_stock and p.quantity<self.amount.value():
+        available = self.available(p) if p is not None else None
+        if available is not None and available<self.amount.value():
             QtGui.QMessageBox.warning(self, 'Quantity mismatch', 'Amount exceeds the product quantity in stock!')
             return
         self.data['description'] = self.description.text()
@@ -5,6 +5,8 @@ from PySide import QtGui, QtCore
 import cbpos
 import sys
 
+from cbmod.sales.controllers import get_formatter
+
 logger = cbpos.get_logger(__name__)
 
 class PayDialog(QtGui.QDialog):
@@ -15,7 +17,7 @@ class PayDialog(QtGui.QDialog):
         
         assert self.manager.ticket is not None, 'Ticket in PayDialog is None'
 
-        self.value = self.manager.ticket.total
+        self.value = self.manager.totals.total
         self.currency = self.manager.currency
         self.customer = self.manager.ticket.customer
         self.payment = None
@@ -77,10 +79,11 @@ class PayDialog(QtGui.QDialog):
         from cbmod.base.controllers import printing
         
         tc = self.manager.ticket.currency
+        formatter = get_formatter()
         
-        job = printing.TablePrintJob(data=[(tl.description, tl.amount, tc.format(tl.total)) for tl in self.manager.ticket.ticketlines],
+        job = printing.TablePrintJob(data=[(tl.description, formatter.number(tl.amount), tc.format(tl.total)) for tl in self.manager.ticket.ticketlines],
                             headers=("Description", "Qty", "Total"),
-                            footers=("", "Total:", tc.format(self.manager.ticket.total))
+                            footers=("", "Total:", tc.format(self.value))
                             )
         
         job.header = "TEL: 04/534031 - 04/534032"
@@ -316,7 +319,7 @@ class DebtPage(AbstractPage):
                 self.maxDebt.setText("")
             else:
                 self.maxDebt.setText(cc.format(c.max_debt))
-            self.currentDebt.setText(cc.format(c.debt))
+            self.currentDebt.setText(cc.format(self.manager.customer_debt(c)))
 
     @property
     def label(self):
@@ -334,5 +337,11 @@ class DebtPage(AbstractPage):
         return self.dialog.customer is not None
 
     def paymentOk(self):
-        if self.dialog.customer is not None:
-            return True
+        c = self.dialog.customer
+        if c is None:
+            return False
+        if not self.manager.is_debt_allowed(c, self.dialog.value):
+            QtGui.QMessageBox.warning(self, cbpos.tr.sales_('Pay ticket'),
+                                      cbpos.tr.sales_('The maximum debt of the customer would be exceeded.'))
+            return False
+        return True
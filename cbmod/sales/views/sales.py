@@ -2,7 +2,11 @@ from PySide import QtGui, QtCore
 
 import cbpos
 
-from cbmod.sales.controllers import SalesManager, TicketSelectionException
+from cbmod.sales.controllers import SalesManager, TicketSelectionException, DebtLimitException, TicketConflictException
+from cbmod.sales.controllers import StockException, JournalReplayException
+from cbmod.sales.controllers import AsyncSalesManager, ObjectRef, ScanBatch
+from cbmod.sales.controllers import assert_no_queries
+from cbmod.sales.controllers.latency import recorder, timed_handler, dump_latency
 from cbmod.currency.controllers import convert
 
 from cbmod.stock.views.widgets import ProductCatalog
@@ -13,12 +17,25 @@ from cbmod.sales.views.widgets import TotalPanel, LogoPanel, TicketTable
 
 from cbmod.base.views import BasePage
 
+logger = cbpos.get_logger(__name__)
+
 class SalesPage(BasePage):
+    
+    operationFinished = QtCore.Signal(object)
+    pageLoaded = QtCore.Signal(object)
+    
     def __init__(self):
         super(SalesPage, self).__init__()
         
         self.manager = SalesManager()
         
+        if cbpos.config['mod.sales', 'async']:
+            self.worker = AsyncSalesManager(self.manager)
+        else:
+            self.worker = None
+        # (success, failure) callbacks of the queued operations, by future
+        self.callbacks = {}
+        
         self.customer = QtGui.QLineEdit()
         self.customer.setReadOnly(True)
         self.customer.setPlaceholderText(cbpos.tr.sales_('No customer selected'))
@@ -128,52 +145,172 @@ class SalesPage(BasePage):
         
         self.catalog.childSelected.connect(self.onProductCatalogItemActivate)
         
+        # Scans are collected for a short window and added at once
+        self.scans = ScanBatch()
+        self.scanTimer = QtCore.QTimer(self)
+        self.scanTimer.setSingleShot(True)
+        self.scanTimer.setInterval(int(cbpos.config['mod.sales', 'scan_window'] or 0))
+        self.scanTimer.timeout.connect(self.flushScans)
+        
+        # Emitted from the database worker thread, delivered in the GUI thread
+        self.operationFinished.connect(self.onOperationFinished)
+        self.pageLoaded.connect(self.onPageLoaded)
+        
+        # Operations are journaled and their commits grouped, if configured
+        self.journalTimer = QtCore.QTimer(self)
+        self.journalTimer.timeout.connect(self.manager.sync_journal)
+        journal = cbpos.config['mod.sales', 'journal']
+        if journal and self.worker is not None:
+            logger.warning('The sales journal is not used with the database worker')
+        elif journal:
+            try:
+                self.manager.open_journal(journal,
+                        sync_interval=int(cbpos.config['mod.sales', 'journal_sync_ms'] or 0)/1000.0,
+                        group_size=int(cbpos.config['mod.sales', 'journal_group'] or 1),
+                        group_interval=int(cbpos.config['mod.sales', 'journal_group_ms'] or 0)/1000.0)
+            except JournalReplayException as e:
+                QtGui.QMessageBox.critical(self, cbpos.tr.sales_('Journal'),
+                        cbpos.tr.sales_('Some sales could not be recovered from the journal {path}. It was kept for inspection.').format(path=journal))
+            else:
+                self.journalTimer.start(int(cbpos.config['mod.sales', 'journal_sync_ms'] or 0))
+        
+        # Writes the latency percentiles of the page
+        self.dumpLatencyShortcut = QtGui.QShortcut(QtGui.QKeySequence('Ctrl+Shift+L'), self)
+        self.dumpLatencyShortcut.activated.connect(dump_latency)
+        
         self.setCurrentTicket(None)
         
+    @timed_handler
     def populate(self):
+        """
+        Refreshes the parts of the page invalidated by the manager since the last call.
+        In async mode the data is loaded on the database worker, and the page
+        is rendered from it once it arrives.
+        """
+        dirty = self.manager.take_dirty()
+        if self.worker is not None:
+            if dirty:
+                future = self.worker.load(dirty)
+                future.add_done_callback(self.pageLoaded.emit)
+            return
         
-        # Set the Ticket field
-        t = self.manager.ticket
-        selected_index = -1
+        with recorder.timed('populate.db'):
+            self.populateData(dirty)
+        self.render(dirty)
+
+    def render(self, dirty):
+        """
+        Renders the parts of the page in dirty from the loaded data.
+        """
+        if cbpos.config['mod.sales', 'assert_render_queries']:
+            with assert_no_queries():
+                self.populateTicket(dirty)
+        else:
+            self.populateTicket(dirty)
         
-        self.tickets.clear()
-        for i, item in enumerate(self.manager.list_tickets()):
-            self.tickets.addItem(item.display, item)
-            if item == t:
-                selected_index = i
-        self.tickets.setCurrentIndex(selected_index)
+        # Fill the catalog
+        if SalesManager.CATALOG in dirty:
+            with recorder.timed('populate.catalog'):
+                self.catalog.populate()
+
+    def populateData(self, dirty):
+        """
+        Fills the ticket and currency lists and loads the current ticket.
+        """
+        tickets = self.manager.list_ticket_summaries() if SalesManager.TICKETS in dirty else None
+        currencies = self.manager.list_currencies() if SalesManager.CURRENCIES in dirty else None
+        self.populateLists(tickets, currencies)
+
+        # Load everything the ticket rendering needs up front
+        if dirty & set((SalesManager.CUSTOMER, SalesManager.DISCOUNT,
+                        SalesManager.TOTALS, SalesManager.LINES)):
+            self.manager.load_ticket()
+
+    def populateLists(self, tickets, currencies):
+        """
+        Fills the ticket list with the TicketSummary list and the currency
+        list with the currencies, unless they are None.
+        """
+        # Set the Ticket field
+        if tickets is not None:
+            ticket_id = self.currentTicketId()
+            selected_index = -1
+            
+            self.tickets.clear()
+            for i, item in enumerate(tickets):
+                self.tickets.addItem(item.display, item.id)
+                if item.id == ticket_id:
+                    selected_index = i
+            self.tickets.setCurrentIndex(selected_index)
         
         # Set the Currency field
-        tc = self.manager.currency
-        self.currency.clear()
-        for i, item in enumerate(self.manager.list_currencies()):
-            self.currency.addItem(item.display, item)
-            if item == tc:
-                self.currency.setCurrentIndex(i)
+        if currencies is not None:
+            tc = self.manager.currency
+            self.currency.clear()
+            for i, item in enumerate(currencies):
+                self.currency.addItem(item.display, item)
+                if tc is not None and item.id == tc.id:
+                    self.currency.setCurrentIndex(i)
 
+    def populateTicket(self, dirty):
+        """
+        Renders the current ticket, which is expected to be loaded already.
+        """
         # Set the Customer field
-        if self.manager.customer is None:
-            self.customer.setText("")
-        else:
-            self.customer.setText(self.manager.customer.display)
+        if SalesManager.CUSTOMER in dirty:
+            if self.manager.customer is None:
+                self.customer.setText("")
+            else:
+                self.customer.setText(self.manager.customer.display)
         
         # Set the Discount field
-        self.discount.setValue(self.manager.discount)
+        if SalesManager.DISCOUNT in dirty:
+            self.discount.setValue(self.manager.discount)
         
         # Set the Total field
-        self.total.updateValues()
+        if SalesManager.TOTALS in dirty:
+            with recorder.timed('populate.totals'):
+                self.total.updateValues()
 
         # Fill the ticketlines table
-        if self.manager.ticket is None:
-            self.ticketTable.empty()
-        else:
-            self.ticketTable.fill()
-        
-        # Fill the catalog
-        self.catalog.populate()
+        if SalesManager.LINES in dirty:
+            with recorder.timed('populate.table'):
+                if self.manager.ticket is None:
+                    self.ticketTable.empty()
+                else:
+                    self.ticketTable.fill()
+
+    def showEvent(self, event):
+        # Other pages may have changed anything in the meantime
+        self.manager.invalidate(*SalesManager.REGIONS)
+        self.manager.stock.invalidate()
+        super(SalesPage, self).showEvent(event)
+
+    def hideEvent(self, event):
+        # Other pages work on the committed state
+        self.flushScans()
+        self.manager.commit_journal()
+        super(SalesPage, self).hideEvent(event)
+
+    def currentTicketId(self):
+        if self.worker is not None:
+            return self.worker.ticket_id
+        t = self.manager.ticket
+        return t.id if t is not None else None
 
     def setCurrentTicket(self, t):
-        self.manager.ticket = t
+        """
+        Makes t the current ticket. In async mode t is the ObjectRef or the id
+        of the ticket, which is loaded on the worker by the next populate.
+        """
+        # Pending scans belong to the previous ticket
+        self.flushScans()
+        if self.worker is None:
+            self.manager.ticket = t
+        else:
+            self.worker.select(t.pk[0] if isinstance(t, ObjectRef) else t)
+            # Not to act on the previous ticket until the new one is loaded
+            self.manager.show_ticket(None)
         
         enabled = t is not None
         self.currency.setEnabled(enabled)
@@ -183,14 +320,87 @@ class SalesPage(BasePage):
         self.payBtn.setEnabled(enabled)
         self.cancelBtn.setEnabled(enabled)
 
+    def execute(self, operation, *args, **kwargs):
+        """
+        Runs the SalesManager operation then refreshes the page. The name of
+        a property, e.g. discount, sets it to the single argument.
+        In async mode the operation is queued on the database worker instead,
+        and the page is refreshed once the queue is drained.
+        
+        The success keyword argument is called with the result before the
+        refresh if the operation succeeds, in the GUI thread. In async mode
+        the result is handed back as ObjectRefs. If the failure keyword
+        argument is given, it is called with the exception instead of the
+        default warning, which is still shown if it returns False.
+        """
+        success = kwargs.pop('success', None)
+        failure = kwargs.pop('failure', None)
+        if self.worker is None:
+            try:
+                if isinstance(getattr(SalesManager, operation), property):
+                    setattr(self.manager, operation, *args)
+                    result = None
+                else:
+                    result = getattr(self.manager, operation)(*args)
+            except Exception as e:
+                if failure is None or not failure(e):
+                    self.warnFailure(e)
+            else:
+                if success is not None:
+                    success(result)
+            finally:
+                self.populate()
+        else:
+            future = self.worker.call(operation, *args)
+            self.callbacks[future] = (success, failure)
+            future.add_done_callback(self.operationFinished.emit)
+
+    def warnFailure(self, e):
+        """
+        Tells about the exception of a failed operation.
+        """
+        if isinstance(e, TicketSelectionException):
+            self.warnTicketSelection()
+        elif isinstance(e, DebtLimitException):
+            self.warnDebtLimit()
+        elif isinstance(e, TicketConflictException):
+            self.warnConflict()
+        elif isinstance(e, StockException):
+            self.warnStock()
+        else:
+            logger.exception('Sales operation failed')
+            QtGui.QMessageBox.warning(self, cbpos.tr.sales_('Error'), unicode(e))
+
     def warnTicketSelection(self):
         QtGui.QMessageBox.warning(self, cbpos.tr.sales_('No ticket'), cbpos.tr.sales_('Select a ticket.'))
     
+    def warnDebtLimit(self):
+        QtGui.QMessageBox.warning(self, cbpos.tr.sales_('Debt'), cbpos.tr.sales_('The maximum debt of the customer would be exceeded.'))
+    
+    def warnConflict(self):
+        QtGui.QMessageBox.warning(self, cbpos.tr.sales_('Conflict'), cbpos.tr.sales_('The ticket was changed on another terminal. Check it and try again.'))
+        self.manager.invalidate(*SalesManager.REGIONS)
+    
+    def warnStock(self):
+        QtGui.QMessageBox.warning(self, cbpos.tr.sales_('Stock'), cbpos.tr.sales_('Some products are not in stock anymore.'))
+    
+    def confirmShortages(self, shortages):
+        """
+        Asks whether to close the ticket anyway if the stock of its products
+        is short. Returns True to close the ticket.
+        """
+        if not shortages:
+            return True
+        answer = QtGui.QMessageBox.question(self, cbpos.tr.sales_('Stock'),
+                    cbpos.tr.sales_('The amount of {count} products exceeds the quantity in stock. Close the ticket anyway?').format(count=len(shortages)),
+                    QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+        return answer == QtGui.QMessageBox.Yes
+    
     def warnTicketlineSelection(self):
         QtGui.QMessageBox.warning(self, cbpos.tr.sales_('No ticketline'), cbpos.tr.sales_('Select a ticketline.'))
 
     def addAmount(self, inc):
-        if self.manager.ticket is None:
+        if self.currentTicketId() is None:
             self.warnTicketSelection()
             return
         
@@ -199,13 +409,15 @@ class SalesPage(BasePage):
             self.warnTicketlineSelection()
             return
         
-        try:
-            self.manager.set_ticketline_amount(tl.amount+inc)
-        except ValueError as e:
+        amount = tl.amount+inc
+        def exceeded(e):
+            if type(e) is not ValueError:
+                return False
             QtGui.QMessageBox.warning(self, 'Warning', 'Amount exceeds the product quantity in stock!')
-            self.manager.set_ticketline_amount(tl.amount+inc, force=True)
+            self.execute('set_ticketline_amount', tl, amount, True)
+            return True
+        self.execute('set_ticketline_amount', tl, amount, failure=exceeded)
         #self.enableTicketlineActions()
-        self.populate()
 
     #####################
     #########   #########
@@ -213,59 +425,73 @@ class SalesPage(BasePage):
     #########   #########
     #####################
     
+    @timed_handler
     def onNewTicketButton(self):
-        self.setCurrentTicket(self.manager.new_ticket())
-        self.populate()
+        self.execute('new_ticket', success=self.setCurrentTicket)
     
+    @timed_handler
     def onCloseTicketButton(self):
-        t = self.manager.ticket
-        if t is None:
+        self.flushScans()
+        if self.currentTicketId() is None:
             self.warnTicketSelection()
             return
         
+        self.execute('stock_shortages', success=self.payTicket)
+    
+    def payTicket(self, shortages):
+        """
+        Asks for the payment of the current ticket and closes it.
+        """
+        if not self.confirmShortages(shortages):
+            return
+        
         dlg = PayDialog(self.manager)
         dlg.exec_()
         if dlg.payment is not None:
             payment_method, paid = dlg.payment
-            self.manager.close_ticket(payment_method, paid)
-            self.setCurrentTicket(None)
-            self.populate()
+            # The shortages were confirmed already. The ticket stays selected
+            # if it could not be closed
+            self.execute('close_ticket', payment_method, paid, True,
+                         success=lambda result: self.setCurrentTicket(None))
     
+    @timed_handler
     def onCancelTicketButton(self):
-        try:
-            self.manager.cancel_ticket()
-        except TicketSelectionException as e:
-            self.warnTicketSelection()
-        else:
-            self.setCurrentTicket(None)
-            self.populate()
+        # The pending scans belong to the cancelled ticket
+        self.flushScans()
+        self.execute('cancel_ticket', success=lambda result: self.setCurrentTicket(None))
     
+    @timed_handler
     def onTicketChanged(self, index):
-        t = self.tickets.itemData(index)
-        self.setCurrentTicket(t)
+        # Only the selected ticket is loaded
+        ticket_id = self.tickets.itemData(index)
+        if self.worker is not None:
+            self.setCurrentTicket(ticket_id)
+        else:
+            self.setCurrentTicket(self.manager.get_ticket(ticket_id) if ticket_id is not None else None)
         self.populate()
     
+    @timed_handler
     def onTicketlineItemChanged(self, currentRow, currentColumn, previousRow, previousColumn):
         self.enableTicketlineActions()
     
+    @timed_handler
     def onNewTicketlineButton(self):
         t = self.manager.ticket
-        if t is None:
+        if self.currentTicketId() is None or t is None:
             self.warnTicketSelection()
             return
         
         data = {'description': '', 'amount': 1, 'sell_price': 0, 'discount': 0, 'ticket': t,
                 'product': None, 'is_edited': False}
         _init_data = data.copy()
-        dlg = EditDialog(data)
+        dlg = EditDialog(data, self.manager)
         dlg.exec_()
         if data != _init_data:
-            self.manager.add_ticketline(data)
-            self.populate()
+            self.execute('add_ticketline', data)
     
+    @timed_handler
     def onEditTicketlineButton(self):
-        t = self.manager.ticket
-        if t is None:
+        if self.currentTicketId() is None:
             self.warnTicketSelection()
             return
         
@@ -277,38 +503,71 @@ class SalesPage(BasePage):
         data = {'description': '', 'sell_price': 0, 'amount': 1, 'discount': 0, 'product': None, 'is_edited': False}
         tl.fillDict(data)
         _init_data = data.copy()
-        dlg = EditDialog(data)
+        dlg = EditDialog(data, self.manager, reserved=tl.amount)
         dlg.exec_()
         if data != _init_data:
-            self.manager.add_ticketline(data)
-            self.populate()
+            self.execute('edit_ticketline', tl, data)
     
+    @timed_handler
     def onPlusTicketlineButton(self):
         self.addAmount(+1)
     
+    @timed_handler
     def onMinusTicketlineButton(self):
         self.addAmount(-1)
 
+    @timed_handler
     def onTicketlineDeleted(self, tl):
-        try:
-            self.manager.remove_ticketline(tl)
-        except TicketSelectionException as e:
-            self.warnTicketSelection()
-        finally:
-            self.populate()
+        self.execute('remove_ticketline', tl)
 
+    @timed_handler
     def onProductCatalogItemActivate(self, p):
         if p is not None:
-            try:
-                self.manager.add_product(p)
-            except TicketSelectionException as e:
-                self.warnTicketSelection()
-            finally:
+            self.scans.add(p)
+            if not self.scanTimer.isActive():
+                self.scanTimer.start()
+
+    @timed_handler
+    def flushScans(self):
+        self.scanTimer.stop()
+        if len(self.scans):
+            self.execute('add_products', self.scans.drain())
+
+    @timed_handler
+    def onOperationFinished(self, future):
+        success, failure = self.callbacks.pop(future, (None, None))
+        try:
+            result = self.worker.finish(future)
+        except Exception as e:
+            if failure is None or not failure(e):
+                self.warnFailure(e)
+        else:
+            if success is not None:
+                success(result)
+        finally:
+            if self.worker.pending == 0:
                 self.populate()
 
+    @timed_handler
+    def onPageLoaded(self, future):
+        try:
+            data = self.worker.finish(future)
+        except Exception as e:
+            self.warnFailure(e)
+            return
+        
+        if data.ticket_id != self.worker.ticket_id:
+            # Another ticket was selected meanwhile, it has its own populate
+            return
+        
+        self.manager.show_ticket(data.ticket)
+        self.populateLists(data.tickets, data.currencies)
+        self.render(data.dirty)
+
+    @timed_handler
     def onCustomerButton(self):
         t = self.manager.ticket
-        if t is None:
+        if self.currentTicketId() is None or t is None:
             self.warnTicketSelection()
             return
         
@@ -316,9 +575,9 @@ class SalesPage(BasePage):
         dlg.setCustomer(t.customer)
         dlg.exec_()
         if dlg.result() == QtGui.QDialog.Accepted:
-            self.manager.customer = dlg.customer
-            self.populate()
+            self.execute('customer', dlg.customer)
 
+    @timed_handler
     def onCurrencyChanged(self, index):
         index = self.currency.currentIndex()
         c = self.currency.itemData(index)
@@ -330,11 +589,7 @@ class SalesPage(BasePage):
         else:
             self.populate()
     
+    @timed_handler
     def onDiscountValueChanged(self):
         value = self.discount.value()
-        try:
-            self.manager.discount = value
-        except TicketSelectionException as e:
-            self.warnTicketSelection()
-        else:
-            self.populate()
+        self.execute('discount', value)
@@ -2,9 +2,10 @@ from PySide import QtGui, QtCore
 
 import cbpos
 
-import babel.numbers
 from decimal import Decimal
 
+from cbmod.sales.controllers import get_formatter
+
 logger = cbpos.get_logger(__name__)
 
 class TotalPanel(QtGui.QFrame):
@@ -35,9 +36,7 @@ class TotalPanel(QtGui.QFrame):
         self.setLayout(layout)
     
     def updateValues(self):
-        subtotal = self.manager.currency_display(self.manager.subtotal)
-        taxes = self.manager.currency_display(self.manager.taxes)
-        total = self.manager.currency_display(self.manager.total)
+        subtotal, taxes, total = self.manager.display_many(self.manager.totals)
         
         self.subtotal.setText(subtotal)
         self.tax.setText(taxes)
@@ -62,7 +61,166 @@ class LogoPanel(QtGui.QFrame):
         
         self.setLayout(layout)
 
-class TicketTable(QtGui.QTableWidget):
+class TicketModel(QtCore.QAbstractTableModel):
+    """
+    Table model over the ticketlines of the current ticket.
+    The first column holds the delete control, the others the texts.
+    """
+    
+    LineRole = QtCore.Qt.UserRole+1
+    
+    def __init__(self, manager, parent=None):
+        super(TicketModel, self).__init__(parent)
+        
+        self.manager = manager
+        
+        self.lines = []
+        self.cells = []
+    
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.lines)
+    
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else 7
+    
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        
+        row, col = index.row(), index.column()
+        if role == QtCore.Qt.DisplayRole and col > 0:
+            return self.cells[row][col-1]
+        elif role == QtCore.Qt.TextAlignmentRole and col == 6:
+            # The last column aligns to the right
+            return int(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+        elif role == self.LineRole:
+            return self.lines[row]
+        return None
+    
+    def flags(self, index):
+        # Items are not editable
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+    
+    def lineCells(self, tl):
+        formatter = get_formatter()
+        sell_price, taxes, total = self.manager.display_many((tl.sell_price, tl.taxes, tl.total))
+        return (
+            # Amount
+            u'{}x'.format(formatter.number(tl.amount)),
+            
+            # [Edited] Description
+            u'{}{}'.format('[*] ' if tl.is_edited else '', tl.description),
+            
+            # Unit Sell Price
+            sell_price,
+            
+            # Taxes
+            u'+ {}'.format(taxes),
+            
+            # Discount
+            '' if tl.discount == 0 else \
+                formatter.percent(-Decimal(tl.discount)/100),
+            
+            # Line Total
+            total,
+        )
+    
+    def sync(self, lines):
+        """
+        Updates the model to show the given ticketlines, signaling only the
+        rows that were removed, inserted or changed.
+        Returns True if rows were inserted or removed.
+        """
+        keys = [tl.id for tl in lines]
+        new_keys = set(keys)
+        
+        # Remove the lines that are gone
+        removed = False
+        for row in reversed(xrange(len(self.lines))):
+            if self.lines[row].id not in new_keys:
+                self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+                del self.lines[row]
+                del self.cells[row]
+                self.endRemoveRows()
+                removed = True
+        
+        old_keys = [tl.id for tl in self.lines]
+        kept_keys = set(old_keys)
+        if old_keys != [k for k in keys if k in kept_keys]:
+            # The lines were reordered, not worth diffing
+            self.beginResetModel()
+            self.lines = list(lines)
+            self.cells = [self.lineCells(tl) for tl in lines]
+            self.endResetModel()
+            return True
+        
+        # Insert the new lines and refresh the ones that changed
+        inserted = False
+        for row, tl in enumerate(lines):
+            cells = self.lineCells(tl)
+            if row < len(self.lines) and self.lines[row].id == tl.id:
+                self.lines[row] = tl
+                if self.cells[row] != cells:
+                    self.cells[row] = cells
+                    self.dataChanged.emit(self.index(row, 1), self.index(row, 6))
+            else:
+                self.beginInsertRows(QtCore.QModelIndex(), row, row)
+                self.lines.insert(row, tl)
+                self.cells.insert(row, cells)
+                self.endInsertRows()
+                inserted = True
+        
+        return removed or inserted
+    
+    def lineAt(self, row):
+        if 0 <= row < len(self.lines):
+            return self.lines[row]
+        return None
+
+class DeleteButtonDelegate(QtGui.QStyledItemDelegate):
+    """
+    Paints a delete button in the cells of its column, without creating widgets.
+    """
+    
+    clicked = QtCore.Signal(int)
+    
+    def __init__(self, parent=None):
+        super(DeleteButtonDelegate, self).__init__(parent)
+        
+        # Check if the icon is available, or fall back to text
+        self.icon = QtGui.QIcon.fromTheme('edit-delete')
+        self.text = cbpos.tr.sales_('Delete') if self.icon.isNull() else ''
+    
+    def buttonOption(self, option):
+        button = QtGui.QStyleOptionButton()
+        button.rect = option.rect.adjusted(1, 1, -1, -1)
+        button.state = QtGui.QStyle.State_Enabled | QtGui.QStyle.State_Raised
+        button.text = self.text
+        if not self.icon.isNull():
+            button.icon = self.icon
+            button.iconSize = QtCore.QSize(16, 16)
+        return button
+    
+    def paint(self, painter, option, index):
+        button = self.buttonOption(option)
+        QtGui.QApplication.style().drawControl(QtGui.QStyle.CE_PushButton, button, painter)
+    
+    def sizeHint(self, option, index):
+        button = self.buttonOption(option)
+        contents = option.fontMetrics.size(QtCore.Qt.TextShowMnemonic, self.text)
+        if not self.icon.isNull():
+            contents = contents.expandedTo(button.iconSize)
+        return QtGui.QApplication.style().sizeFromContents(QtGui.QStyle.CT_PushButton,
+                                                           button, contents)
+    
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QtCore.QEvent.MouseButtonRelease and \
+                option.rect.contains(event.pos()):
+            self.clicked.emit(index.row())
+            return True
+        return False
+
+class TicketTable(QtGui.QTableView):
     
     lineDeleted = QtCore.Signal('QVariant')
     
@@ -71,16 +229,24 @@ class TicketTable(QtGui.QTableWidget):
         
         self.manager = manager
         
-        self.setColumnCount(7)
+        self.ticketModel = TicketModel(manager, self)
+        self.setModel(self.ticketModel)
+        
+        self.deleteDelegate = DeleteButtonDelegate(self)
+        self.deleteDelegate.clicked.connect(self.onDelete)
+        self.setItemDelegateForColumn(0, self.deleteDelegate)
+        
         self.verticalHeader().setVisible(False)
         self.horizontalHeader().setVisible(False)
+        self.horizontalHeader().setStretchLastSection(True)
         self.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
         self.setShowGrid(False)
+        # This is important so that the row numbers do not change while adding 2 items on the same line
+        self.setSortingEnabled(False)
         
     def empty(self):
-        self.clearContents()
-        self.setRowCount(0)
-        self.resizeColumnsToContents()
+        if self.ticketModel.sync([]):
+            self.resizeColumnsToContents()
 
     def fill(self):
         t = self.manager.ticket
@@ -88,72 +254,17 @@ class TicketTable(QtGui.QTableWidget):
             self.empty()
             return
         
-        tls = list(t.ticketlines)
-        tc = t.currency
-        
-        self.setRowCount(len(tls))
-        # This is important so that the row numbers do not change while adding 2 items on the same line
-        self.setSortingEnabled(False)
-        
-        icon = QtGui.QIcon.fromTheme('edit-delete')
-        for row, tl in enumerate(tls):
-            cols = (
-                # Amount
-                u'{}x'.format(babel.numbers.format_number(tl.amount,
-                                                          locale=cbpos.locale)),
-                
-                # [Edited] Description
-                u'{}{}'.format('[*] ' if tl.is_edited else '', tl.description),
-                
-                # Unit Sell Price
-                self.manager.currency_display(tl.sell_price),
-                
-                # Taxes
-                u'+ {}'.format(self.manager.currency_display(tl.taxes)),
-                
-                # Discount
-                '' if tl.discount == 0 else \
-                    babel.numbers.format_percent(-Decimal(tl.discount)/100,
-                                                 locale=cbpos.locale),
-                
-                # Line Total
-                self.manager.currency_display(tl.total),
-            )
-            
-            # Check if the icon is available, or fall back to text
-            if icon.isNull():
-                controls_item = QtGui.QPushButton(cbpos.tr.sales_('Delete'))
-            else:
-                controls_item = QtGui.QPushButton()
-                controls_item.setIcon(icon)
-            
-            controls_item.callback = lambda a=tl: self.onDelete(a)
-            controls_item.pressed.connect(controls_item.callback)
-            
-            # Add the delete button in the beginning
-            self.setCellWidget(row, 0, controls_item)
-            
-            # Then add the other columns
-            for col, item_text in enumerate(cols):
-                table_item = QtGui.QTableWidgetItem(item_text)
-                table_item.setData(QtCore.Qt.UserRole+1, tl)
-                # Items are not enabled
-                table_item.setFlags(table_item.flags() ^ QtCore.Qt.ItemIsEditable)
-                
-                # Add 1 to columns, because there is one column before them all
-                self.setItem(row, col + 1, table_item)
-            
-            # The last item aligns to the right
-            table_item.setTextAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
-            
-        self.resizeColumnsToContents()
-        self.horizontalHeader().setStretchLastSection(True)
+        # Columns are only resized when rows come or go
+        if self.ticketModel.sync(list(t.ticketlines)):
+            self.resizeColumnsToContents()
     
     def currentLine(self):
-        item = self.currentItem()
-        if item is None:
+        index = self.currentIndex()
+        if not index.isValid():
             return None
-        return item.data(QtCore.Qt.UserRole+1)
+        return self.ticketModel.lineAt(index.row())
     
-    def onDelete(self, line):
-        self.lineDeleted.emit(line)
+    def onDelete(self, row):
+        line = self.ticketModel.lineAt(row)
+        if line is not None:
+            self.lineDeleted.emit(line)